@@ -1,4 +1,10 @@
 import os
+import sys
+import gzip
+import shutil
+import time
+import queue
+import threading
 from atexit import register as ae_register
 from datetime import timedelta
 from datetime import datetime as dt
@@ -33,6 +39,29 @@ class EasyLogging:
 			to that length (log datestamp not included).
 
 			sep:str - separator between columns.
+
+			background:bool - write messages from a separate
+			thread in batches. The caller only formats the
+			message and puts it into a queue.
+
+			flush_interval:float - in background mode flush
+			console and file at least this often (seconds).
+
+			flush_size:int - in background mode flush when
+			this many messages are waiting.
+
+			max_size:int - start a new file when the current
+			one is bigger than this (bytes). Old file gets
+			a number: 2022-01-03.1.log
+
+			keep_files:int - how many old files to keep.
+
+			keep_size:int - max total size of old files (bytes).
+
+			compress:bool - gzip old files.
+
+			Compression and removal of old files are done
+			in a separate thread.
 	'''
 	def __init__(
 		s
@@ -48,6 +77,13 @@ class EasyLogging:
 		}
 		, line_max_len:int=None
 		, sep:str = ' : '
+		, background:bool=False
+		, flush_interval:float=1.0
+		, flush_size:int=100
+		, max_size:int=None
+		, keep_files:int=None
+		, keep_size:int=None
+		, compress:bool=False
 	):
 		s.levels = levels
 		if add_levels:
@@ -56,8 +92,9 @@ class EasyLogging:
 					s.levels[l] = n
 			else:
 				s.levels[add_levels[0]] = add_levels[1]
-		s.level = level
 		s.time_format = time_format
+		s.file_name_format = file_name_format
+		s._stamp = (None, '', '')
 		for key, value in levels.items():
 			setattr(
 				EasyLogging
@@ -65,51 +102,186 @@ class EasyLogging:
 				, lambda s, *strings, l=key: s._log(*strings, lvl=l)
 			)
 			setattr(EasyLogging, key.upper(), value)
+		s.level = level
 		s.lvl_pad = max(*map(len, levels))
 		s.sep = sep
 		s.line_max_len = line_max_len
 		s.filed = None
+		s.max_size = max_size
+		s.keep_files = keep_files
+		s.keep_size = keep_size
+		s.compress = compress
+		s.hk_lock = threading.Lock()
 		if directory:
 			if not os.path.exists(directory): os.mkdir(directory)
-			s.file_name_format = file_name_format
 			s.directory = directory
-			s.file_name = dt.now().strftime(
-				file_name_format)
-			s.filed = open(
-				os.path.join(s.directory, s.file_name)
-				, 'ta+'
-			)
+			s._open(s._now()[2])
+		s.queue = None
+		if background:
+			s.queue = queue.SimpleQueue()
+			s.flush_interval = flush_interval
+			s.flush_size = flush_size
+			s.writer = threading.Thread(target=s._writer, daemon=True)
+			s.writer.start()
 		ae_register(s._cleanup)
 
+	@property
+	def level(s)->int:
+		return s._level
+
+	@level.setter
+	def level(s, value:int):
+		''' Methods of the levels below this one
+			are replaced with a function that does nothing.
+		'''
+		s._level = value
+		for key, num in s.levels.items():
+			if num < value:
+				setattr(s, key.lower(), s._skip)
+			else:
+				s.__dict__.pop(key.lower(), None)
+
+	@staticmethod
+	def _skip(*strings, **kwargs):
+		pass
+
+	def _now(s)->tuple:
+		' (second, time string, file name) cached for a second '
+		sec = int(time.time())
+		if sec != s._stamp[0]:
+			now = dt.fromtimestamp(sec)
+			s._stamp = (
+				sec
+				, now.strftime(s.time_format)
+				, now.strftime(s.file_name_format)
+			)
+		return s._stamp
+
 	def _log(s, *strings, lvl:str='DEBUG'):
 		'Log to console and optionally to disk'
 		if s.levels.get(lvl, s.level) < s.level: return
 		msg = s.sep.join(map(str, strings))
 		if s.line_max_len: msg = msg[:s.line_max_len]
-		t = dt.now().strftime(s.time_format)
+		t = s._now()[1]
 		msg = f'{t}{s.sep}{lvl:{s.lvl_pad}}{s.sep}{msg}'
+		if s.queue:
+			s.queue.put(msg)
+			return
 		print(msg)
 		if not s.filed: return
 		s._write_to_file(msg)
+		s.filed.flush()
+
+	def _writer(s):
+		' Write messages from the queue in batches '
+		batch = []
+		flushed = time.monotonic()
+		while True:
+			try:
+				msg = s.queue.get(timeout=s.flush_interval)
+			except queue.Empty:
+				msg = ''
+			if msg is None:
+				s._flush(batch)
+				return
+			if msg: batch.append(msg)
+			if len(batch) >= s.flush_size \
+			or time.monotonic() - flushed >= s.flush_interval:
+				s._flush(batch)
+				batch = []
+				flushed = time.monotonic()
+
+	def _flush(s, batch:list):
+		if not batch: return
+		text = '\n'.join(batch)
+		try:
+			sys.stdout.write(text + '\n')
+			sys.stdout.flush()
+		except Exception:
+			pass
+		if not s.filed: return
+		s._write_to_file(text)
+		s.filed.flush()
 		
 	def _cleanup(s):
+		if s.queue:
+			s.queue.put(None)
+			s.writer.join(5)
+			s.queue = None
 		if not s.filed: return
 		s._log('cleanup', lvl='DEBUG')
 		s.filed.close()
 	
+	def _open(s, file_name:str):
+		s.file_name = file_name
+		s.filed = open(
+			os.path.join(s.directory, s.file_name)
+			, 'ta+'
+		)
+		s.file_size = s.filed.tell()
+
 	def _write_to_file(s, msg):
-		fn = dt.now().strftime(s.file_name_format)
+		fn = s._now()[2]
+		size = len(msg) + 1
 		if fn != s.file_name:
-			s.file_name = fn
 			s.filed.close()
-			s.filed = open(
-				os.path.join(s.directory, s.file_name)
-				, 'ta+'
-			)
+			s._housekeep(os.path.join(s.directory, s.file_name))
+			s._open(fn)
+		elif s.max_size and s.file_size \
+		and s.file_size + size > s.max_size:
+			s.filed.close()
+			s._housekeep(s._rotate())
+			s._open(fn)
 		s.filed.write(msg + '\n')
-		s.filed.flush()
+		s.file_size += size
+
+	def _rotate(s)->str:
+		' Rename current file to the next free number '
+		base, ext = os.path.splitext(s.file_name)
+		num = 0
+		for f in os.listdir(s.directory):
+			if not f.startswith(base + '.'): continue
+			n = f[len(base) + 1:].split('.')[0]
+			if n.isdigit(): num = max(num, int(n))
+		path = os.path.join(s.directory, f'{base}.{num + 1}{ext}')
+		os.replace(os.path.join(s.directory, s.file_name), path)
+		return path
+
+	def _housekeep(s, path:str):
+		' Compress closed file and remove old ones in a thread '
+		if not (s.compress or s.keep_files or s.keep_size): return
+		threading.Thread(target=s._housekeeper, args=(path,)
+			, daemon=True).start()
+
+	def _housekeeper(s, path:str):
+		with s.hk_lock:
+			try:
+				if s.compress and os.path.exists(path):
+					with open(path, 'rb') as fs \
+					, gzip.open(path + '.gz', 'wb') as fd:
+						shutil.copyfileobj(fs, fd)
+					os.remove(path)
+				ext = os.path.splitext(s.file_name)[1]
+				old = []
+				for f in os.scandir(s.directory):
+					if f.name == s.file_name: continue
+					if not (f.name.endswith(ext)
+					or f.name.endswith(ext + '.gz')): continue
+					st = f.stat()
+					old.append((st.st_mtime, st.st_size, f.path))
+				old.sort(reverse=True)
+				total = 0
+				for num, (_, size, fpath) in enumerate(old):
+					total += size
+					if (s.keep_files is not None
+					and num >= s.keep_files) \
+					or (s.keep_size and total > s.keep_size):
+						os.remove(fpath)
+			except Exception as e:
+				print(f'EasyLogging: housekeeping error: {e!r}')
 
 	def __getattr__(s, name):
+		if name.startswith('_'): raise AttributeError(name)
 		def method(*args, **kwargs):
 			s._log(lvl=name.upper(), *args, **kwargs)
 		return method
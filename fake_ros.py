@@ -0,0 +1,109 @@
+''' Fake RouterOS API server for benchmarks.
+	It speaks the same word/sentence protocol as ApiRos
+	(without TLS) and keeps firewall address lists
+	in memory.
+'''
+import socket
+import threading
+import time
+from rosapi import ApiRos
+
+class FakeRos:
+	''' Fake device.
+		latency - delay before every reply (seconds).
+	'''
+	def __init__(self, latency:float=0, host:str='127.0.0.1'
+	, port:int=0):
+		self.latency = latency
+		self.lists = {}
+		self.lock = threading.Lock()
+		self.commands = 0
+		self.next_id = 1
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.bind((host, port))
+		self.port = self.sock.getsockname()[1]
+
+	def start(self)->int:
+		''' Start accepting in a thread. Return the port. '''
+		self.sock.listen(64)
+		threading.Thread(target=self._accept, daemon=True).start()
+		return self.port
+
+	def stop(self):
+		self.sock.close()
+
+	def _accept(self):
+		while True:
+			try:
+				conn, _ = self.sock.accept()
+			except OSError:
+				return
+			conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			threading.Thread(target=self._serve, args=(conn,)
+				, daemon=True).start()
+
+	def _serve(self, conn:socket.socket):
+		apiros = ApiRos(conn)
+		try:
+			while True:
+				reply, attrs = apiros.readReply()
+				tag = attrs.pop('.tag', None)
+				with self.lock:
+					self.commands += 1
+					sentences = self.execute(reply, attrs)
+				if self.latency: time.sleep(self.latency)
+				for words in sentences:
+					if tag is not None: words.append('.tag=' + tag)
+					apiros.writeSentence(words)
+		except (OSError, RuntimeError):
+			conn.close()
+
+	def execute(self, cmd:str, attrs:dict)->list:
+		''' Return list of reply sentences for the command '''
+		if cmd == '/ip/firewall/address-list/add':
+			lst = self.lists.setdefault(attrs.get('=list', ''), {})
+			address = attrs.get('=address', '')
+			if address in lst:
+				return [
+					['!trap', '=message=failure: already have such entry']
+					, ['!done']
+				]
+			ros_id = f'*{self.next_id:X}'
+			self.next_id += 1
+			lst[address] = {
+				'.id' : ros_id
+				, 'address' : address
+				, 'timeout' : attrs.get('=timeout', '')
+				, 'comment' : attrs.get('=comment', '')
+			}
+			return [['!done', '=ret=' + ros_id]]
+		elif cmd == '/ip/firewall/address-list/remove':
+			ids = set(attrs.get('=.id', '').split(','))
+			for lst in self.lists.values():
+				for address in [a for a, e in lst.items()
+				if e['.id'] in ids]:
+					del lst[address]
+			return [['!done']]
+		elif cmd == '/ip/firewall/address-list/print':
+			lst = self.lists.get(attrs.get('?list', ''), {})
+			return [
+				['!re', *(f'={k}={v}' for k, v in e.items() if v)]
+					for e in lst.values()
+			] + [['!done']]
+		elif cmd == '/system/identity/print':
+			return [['!re', '=name=FakeRos'], ['!done']]
+		elif cmd in ('/login', '/log/info'):
+			return [['!done']]
+		return [
+			['!trap', '=message=no such command']
+			, ['!done']
+		]
+
+if __name__ == '__main__':
+	dev = FakeRos(port=8728)
+	print(f'Fake RouterOS API on port {dev.start()}')
+	try:
+		while True: time.sleep(1)
+	except KeyboardInterrupt:
+		dev.stop()
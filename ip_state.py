@@ -0,0 +1,737 @@
+import gc
+import threading
+import time
+from collections import OrderedDict
+from socket import inet_aton, inet_pton, inet_ntop, AF_INET, AF_INET6
+
+IPV6_FLAG = 1 << 128
+
+def ip_key(ip:str)->int:
+	''' Pack IPv4 or IPv6 address to int.
+		IPv6 keys have the 129th bit set so they
+		never collide with IPv4 ones.
+	'''
+	if ':' in ip:
+		return int.from_bytes(inet_pton(AF_INET6, ip), 'big') \
+			| IPV6_FLAG
+	return int.from_bytes(inet_aton(ip), 'big')
+
+def check_prefixes(prefix:int, prefix6:int):
+	' Raise ValueError if a prefix length is out of range '
+	if not (0 < prefix <= 32 and 0 < prefix6 <= 128):
+		raise ValueError(f'wrong prefix length: {prefix}, {prefix6}')
+
+class PrefixSet:
+	''' Set of IPv4 and IPv6 networks like '10.1.0.0/22',
+		'2001:db8::/32' or single addresses.
+		Networks are kept as one set of network numbers per
+		prefix length, so a lookup costs at most one set
+		check per distinct prefix length, however many
+		networks there are.
+	'''
+	def __init__(self, networks=()):
+		self.networks = []
+		self.prefixes = ({}, {})
+		for net in networks: self.add(net)
+
+	def __len__(self):
+		return len(self.networks)
+
+	def __repr__(self):
+		return f'PrefixSet({self.networks})'
+
+	def add(self, network:str):
+		''' Add network in CIDR notation or single
+			address. Host bits are ignored.
+		'''
+		network = network.strip()
+		if not network: return
+		ip, _, length = network.partition('/')
+		v6, num, bits = _split_key(ip_key(ip))
+		length = int(length) if length else bits
+		if not 0 <= length <= bits:
+			raise ValueError(f'wrong prefix length: {network}')
+		self.prefixes[v6].setdefault(length, set()) \
+			.add(num >> (bits - length))
+		self.networks.append(network)
+
+	def __contains__(self, ip:str):
+		try:
+			v6, num, bits = _split_key(ip_key(ip))
+		except OSError:
+			return False
+		for length, nets in self.prefixes[v6].items():
+			if num >> (bits - length) in nets: return True
+		return False
+
+	def overlaps(self, network:str)->bool:
+		' Does any network of the set intersect this one? '
+		ip, _, length = network.partition('/')
+		v6, num, bits = _split_key(ip_key(ip))
+		length = int(length) if length else bits
+		num >>= bits - length
+		for plen, nets in self.prefixes[v6].items():
+			if plen <= length:
+				if num >> (length - plen) in nets: return True
+			elif any(n >> (plen - length) == num for n in nets):
+				return True
+		return False
+
+def _split_key(key:int)->tuple:
+	' (is IPv6, address number, address bits) '
+	if key & IPV6_FLAG: return True, key ^ IPV6_FLAG, 128
+	return False, key, 32
+
+class NetAggregator:
+	''' Networks with many blacklisted addresses.
+		*add* counts distinct addresses blacklisted in a
+		network (/prefix for IPv4, /prefix6 for IPv6) during
+		*window* seconds. When there are more than
+		*threshold* of them the network should go to the
+		black list instead of the addresses. 0 - never.
+		Device ids of the address entries are kept so they
+		can be removed when the network is on the device.
+	'''
+	def __init__(self, prefix:int=24, prefix6:int=64
+	, threshold:int=0, window:float=3600, size:int=10_000):
+		self.prefix = prefix
+		self.prefix6 = prefix6
+		self.threshold = threshold
+		self.window = window
+		self.size = size
+		# (is IPv6, network number) -> {ip: [time, device id]}
+		self.members = OrderedDict()
+		# (is IPv6, network number) ->
+		# [network, expires, confirmed, time of change]
+		self.black = {}
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.black)
+
+	def configure(self, prefix:int, prefix6:int, threshold:int
+	, window:float):
+		''' Change parameters. Counters and networks are
+			dropped if the prefix length changes.
+		'''
+		check_prefixes(prefix, prefix6)
+		with self.lock:
+			if (prefix, prefix6) != (self.prefix, self.prefix6):
+				self.members.clear()
+				self.black.clear()
+			self.prefix = prefix
+			self.prefix6 = prefix6
+			self.threshold = threshold
+			self.window = window
+
+	def _net(self, ip:str)->tuple:
+		''' Key of the network of IP and the network
+			in CIDR notation.
+		'''
+		v6, num, bits = _split_key(ip_key(ip))
+		length = self.prefix6 if v6 else self.prefix
+		num >>= bits - length
+		addr = inet_ntop(AF_INET6 if v6 else AF_INET
+			, (num << (bits - length)).to_bytes(bits // 8, 'big'))
+		return (v6, num), f'{addr}/{length}'
+
+	def is_black(self, ip:str)->bool:
+		''' Is the network of IP in the black list and
+			not expired yet?
+		'''
+		if not self.black: return False
+		try:
+			entry = self.black.get(self._net(ip)[0])
+		except OSError:
+			return False
+		return bool(entry) and (not entry[1] or entry[1] > time.time())
+
+	def add(self, ip:str)->str:
+		''' Count the blacklisted IP. Return its network
+			in CIDR notation when the network should be
+			blacklisted, otherwise None.
+		'''
+		if not self.threshold: return None
+		now = time.time()
+		key, network = self._net(ip)
+		with self.lock:
+			entry = self.black.get(key)
+			if entry and (not entry[1] or entry[1] > now):
+				return None
+			ips = self.members.get(key)
+			if ips is None:
+				ips = self.members[key] = {}
+				while len(self.members) > self.size:
+					self.members.popitem(last=False)
+			else:
+				self.members.move_to_end(key)
+			old = ips.get(ip)
+			ips[ip] = [now, old[1] if old else None]
+			old = now - self.window
+			for stale in [a for a, m in ips.items() if m[0] < old]:
+				del ips[stale]
+			if len(ips) > self.threshold: return network
+		return None
+
+	def set_black(self, network:str, expires:float=None
+	, confirmed:bool=False)->bool:
+		''' Mark the network as blacklisted.
+			confirmed - the device already has it.
+			Return False if the prefix length of the network
+			is not the configured one.
+		'''
+		ip, _, length = network.partition('/')
+		key, net = self._net(ip)
+		if net != f'{ip}/{length}': return False
+		with self.lock:
+			self.black[key] = [network, expires, confirmed, time.time()]
+			if len(self.black) > self.size:
+				now = time.time()
+				for k, e in list(self.black.items()):
+					if e[1] and e[1] < now: del self.black[k]
+		return True
+
+	def discard(self, network:str):
+		' Forget the blacklisted network '
+		with self.lock:
+			self.black.pop(self._net(network.partition('/')[0])[0], None)
+
+	def reconcile(self, networks:list, before:float)->int:
+		''' Forget networks that the device had but
+			does not have any more: confirmed ones that are
+			not in *networks* and did not change since
+			*before*. Return the number of forgotten ones.
+		'''
+		keys = {self._net(n.partition('/')[0])[0] for n in networks}
+		with self.lock:
+			gone = [k for k, e in self.black.items()
+				if e[2] and e[3] < before and k not in keys]
+			for key in gone: del self.black[key]
+		return len(gone)
+
+	def retire(self, network:str)->list:
+		''' The device has the network now. Return device
+			ids of its addresses and forget them.
+		'''
+		key = self._net(network.partition('/')[0])[0]
+		with self.lock:
+			entry = self.black.get(key)
+			if entry:
+				entry[2] = True
+				entry[3] = time.time()
+			ips = self.members.pop(key, {})
+		return [m[1] for m in ips.values() if m[1]]
+
+	def found(self, ip:str, ros_id:str)->bool:
+		''' The device added IP with this id.
+			Return True if the entry is not needed because
+			the network is already on the device.
+		'''
+		if not ros_id or not (self.threshold or self.black):
+			return False
+		key = self._net(ip)[0]
+		with self.lock:
+			entry = self.black.get(key)
+			if entry and entry[2] and (not entry[1]
+			or entry[1] > time.time()):
+				return True
+			ips = self.members.get(key)
+			if ips and ip in ips: ips[ip][1] = ros_id
+		return False
+
+class IpRecord:
+	''' State of one IP address.
+		status - 'grey', 'white' or 'black'.
+		expires - time.time() when the device removes
+		the address from the list, None - never.
+		touched - time.time() of the last request.
+		since - time.time() of the last status change.
+		counter - number of bad events since the last
+		reset, bad - times of the last of them (see
+		*bad_event*).
+	'''
+	__slots__ = ('key', 'ip', 'counter', 'status', 'reason'
+		, 'user', 'expires', 'touched', 'since', 'bad')
+
+	def __init__(self, key:int, ip:str, user:str=None):
+		self.key = key
+		self.ip = ip
+		self.counter = 0
+		self.status = 'grey'
+		self.reason = 'new'
+		self.user = user
+		self.expires = None
+		self.touched = time.time()
+		self.since = self.touched
+		self.bad = None
+
+	def __repr__(self):
+		return f'IpRecord({self.ip}, {self.status}, {self.reason})'
+
+	def bad_event(self, threshold:int, window:float=0)->int:
+		''' Register a bad event and return how many of
+			them were during the last *window* seconds
+			(0 - ever), no more than *threshold*.
+			Times of the last *threshold* events are kept
+			in a ring, so the threshold is reached exactly
+			when the oldest of them is recent: one check.
+			Below the threshold recent times are counted
+			from the newest one back.
+		'''
+		now = time.time()
+		threshold = max(threshold, 1)
+		ring = self.bad
+		if not ring or len(ring) != threshold:
+			ring = self.bad = [0.0] * threshold
+			self.counter = 0
+		ring[self.counter % threshold] = now
+		self.counter += 1
+		if not window: return min(self.counter, threshold)
+		old = now - window
+		if self.counter >= threshold \
+		and ring[self.counter % threshold] > old:
+			return threshold
+		cnt = 0
+		for i in range(1, min(self.counter, threshold)):
+			if ring[(self.counter - 1 - i) % threshold] <= old: break
+			cnt += 1
+		return cnt + 1
+
+	def reset(self):
+		' Forget bad events '
+		self.counter = 0
+		self.bad = None
+
+class Stripes:
+	''' Fixed set of locks. The lock for a key is
+		picked by its hash so unrelated keys rarely
+		wait for each other.
+	'''
+	def __init__(self, count:int=64):
+		self.locks = [threading.Lock() for _ in range(count)]
+
+	def __call__(self, key)->threading.Lock:
+		return self.locks[hash(key) % len(self.locks)]
+
+class _Shard:
+	__slots__ = ('lock', 'records', 'grey', 'listed', 'purged')
+
+	def __init__(self):
+		self.lock = threading.RLock()
+		self.records = {}
+		self.grey = OrderedDict()
+		# black and white records
+		self.listed = OrderedDict()
+		self.purged = time.time()
+
+class IpTable:
+	''' IP addresses seen by the server.
+		Grey records are evicted when they were not touched
+		for *grey_ttl* seconds or when the table holds more
+		than *size* of them (least recently touched first).
+		Black and white records stay until they expire
+		on the device, but there are no more than *size*
+		of them either: the least recently touched ones
+		are dropped, the device still has them.
+		The table is split into *stripes* shards by key,
+		every shard has its own lock, so use *update* to
+		change a record atomically.
+		Keys of black records are also kept in the *black*
+		set for a quick check without locks.
+	'''
+	PURGE_INTERVAL = 60
+
+	def __init__(self, size:int=100_000, grey_ttl:float=86400
+	, stripes:int=64):
+		self.size = size
+		self.grey_ttl = grey_ttl
+		self.shards = [_Shard() for _ in range(stripes)]
+		self.black = set()
+
+	def __len__(self):
+		return sum(len(sh.records) for sh in self.shards)
+
+	def __contains__(self, ip:str):
+		return self.get(ip) is not None
+
+	def values(self)->list:
+		recs = []
+		for sh in self.shards:
+			with sh.lock: recs.extend(sh.records.values())
+		return recs
+
+	def is_black(self, ip:str)->bool:
+		''' Is IP in the black list and not expired yet? '''
+		key = ip_key(ip)
+		if key not in self.black: return False
+		rec = self._shard(key).records.get(key)
+		if not rec: return False
+		return not rec.expires or rec.expires > time.time()
+
+	def _shard(self, key:int)->_Shard:
+		return self.shards[key % len(self.shards)]
+
+	def get(self, ip:str)->IpRecord:
+		''' Record of IP or None '''
+		key = ip_key(ip)
+		sh = self._shard(key)
+		with sh.lock:
+			rec = sh.records.get(key)
+			if rec and rec.expires and rec.expires < time.time():
+				self._expire(sh, rec)
+			return rec
+
+	def add(self, ip:str, user:str=None)->IpRecord:
+		''' Get record of IP or create new grey one
+			and mark it as touched.
+		'''
+		return self.update(ip, lambda rec: rec, user)
+
+	def update(self, ip:str, func, user:str=None):
+		''' Call func(record) under the lock of the
+			record and return its result. The record
+			is created if needed and marked as touched.
+		'''
+		now = time.time()
+		key = ip_key(ip)
+		sh = self._shard(key)
+		with sh.lock:
+			rec = sh.records.get(key)
+			if rec:
+				rec.touched = now
+				if rec.status == 'grey':
+					sh.grey.move_to_end(key)
+				elif rec.expires and rec.expires < now:
+					self._expire(sh, rec)
+				else:
+					sh.listed.move_to_end(key)
+			else:
+				rec = IpRecord(key, ip, user)
+				sh.records[key] = rec
+				sh.grey[key] = rec
+				self._evict(sh, now, key)
+			return func(rec)
+
+	def set_status(self, rec:IpRecord, status:str
+	, expires:float=None):
+		''' Change the status of the record.
+			expires - for black and white records.
+		'''
+		sh = self._shard(rec.key)
+		with sh.lock:
+			if status == 'grey':
+				rec.expires = None
+				if rec.status != 'grey':
+					sh.listed.pop(rec.key, None)
+					sh.grey[rec.key] = rec
+			else:
+				rec.expires = expires
+				sh.grey.pop(rec.key, None)
+				if rec.key not in sh.listed:
+					sh.listed[rec.key] = rec
+					self._trim(sh, rec.key)
+			if status == 'black':
+				self.black.add(rec.key)
+			else:
+				self.black.discard(rec.key)
+			if rec.status != status: rec.since = time.time()
+			rec.status = status
+
+	def remove(self, rec:IpRecord):
+		sh = self._shard(rec.key)
+		with sh.lock:
+			sh.records.pop(rec.key, None)
+			sh.grey.pop(rec.key, None)
+			sh.listed.pop(rec.key, None)
+			self.black.discard(rec.key)
+
+	def dump(self)->list:
+		''' Records as tuples of plain values.
+			Records go in the order of eviction.
+		'''
+		rows = []
+		for sh in self.shards:
+			with sh.lock:
+				recs = [*sh.listed.values(), *sh.grey.values()]
+			rows.extend(
+				(rec.key, rec.ip, rec.counter, rec.status, rec.reason
+				, rec.user, rec.expires, rec.touched, rec.since, rec.bad)
+					for rec in recs
+			)
+		return rows
+
+	def restore(self, rows:list)->int:
+		''' Load records from *dump* skipping expired
+			and already known ones. Rows of older versions
+			without the 'bad' field are accepted too.
+			Return number of loaded records.
+		'''
+		# Records have no reference cycles, but the collector
+		# would walk all of them again and again while
+		# they are created
+		gc_on = gc.isenabled()
+		gc.disable()
+		try:
+			return self._restore(rows)
+		finally:
+			if gc_on: gc.enable()
+
+	def _restore(self, rows:list)->int:
+		now = time.time()
+		old = now - self.grey_ttl
+		stripes = len(self.shards)
+		parts = [[] for _ in range(stripes)]
+		for row in rows:
+			if row[3] == 'grey':
+				if row[7] < old: continue
+			elif row[6] and row[6] < now:
+				continue
+			if len(row) == 9: row = (*row, None)
+			parts[row[0] % stripes].append(row)
+		new = IpRecord.__new__
+		num = 0
+		for sh, part in zip(self.shards, parts):
+			with sh.lock:
+				records = sh.records
+				for (key, ip, counter, status, reason
+				, user, expires, touched, since, bad) in part:
+					if key in records: continue
+					rec = new(IpRecord)
+					rec.key = key
+					rec.ip = ip
+					rec.counter = counter
+					rec.status = status
+					rec.reason = reason
+					rec.user = user
+					rec.expires = expires
+					rec.touched = touched
+					rec.since = since
+					rec.bad = bad
+					records[key] = rec
+					if status == 'grey':
+						sh.grey[key] = rec
+					else:
+						sh.listed[key] = rec
+						if status == 'black': self.black.add(key)
+					num += 1
+				self._evict(sh, now)
+		return num
+
+	def purge(self):
+		''' Drop expired grey records and turn expired
+			black and white records to grey.
+		'''
+		for sh in self.shards:
+			with sh.lock: self._purge(sh, time.time())
+
+	def _purge(self, sh:_Shard, now:float, keep:int=None):
+		sh.purged = now
+		for rec in list(sh.listed.values()):
+			if rec.expires and rec.expires < now:
+				self._expire(sh, rec)
+		self._evict(sh, now, keep)
+
+	def _expire(self, sh:_Shard, rec:IpRecord):
+		self.set_status(rec, 'grey')
+		rec.reset()
+		rec.reason = 'expired'
+
+	def _evict(self, sh:_Shard, now:float, keep:int=None):
+		''' Drop old grey records and the ones over the
+			share of *size* of the shard, but never
+			the *keep* one.
+		'''
+		if now - sh.purged > self.PURGE_INTERVAL:
+			self._purge(sh, now, keep)
+			return
+		old = now - self.grey_ttl
+		size = max(self.size // len(self.shards), 1)
+		while sh.grey:
+			key, rec = next(iter(sh.grey.items()))
+			if key == keep \
+			or (len(sh.grey) <= size and rec.touched > old):
+				break
+			del sh.records[key]
+			del sh.grey[key]
+		self._trim(sh, keep)
+
+	def _trim(self, sh:_Shard, keep:int=None):
+		' Drop black and white records over the share of *size* '
+		size = max(self.size // len(self.shards), 1)
+		while len(sh.listed) > size:
+			key = next(iter(sh.listed))
+			if key == keep: break
+			del sh.records[key]
+			del sh.listed[key]
+			self.black.discard(key)
+
+class GrantCache:
+	''' When white list entries of (user, IP)
+		expire on the device.
+	'''
+	def __init__(self, size:int=10_000):
+		self.size = size
+		self.grants = {}
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.grants)
+
+	def items(self)->list:
+		with self.lock: return list(self.grants.items())
+
+	def left(self, user:str, ip:str)->float:
+		''' Seconds before the entry expires, 0 if
+			there is no entry.
+		'''
+		expires = self.grants.get((user, ip), 0)
+		if expires is None: return float('inf')
+		return max(expires - time.time(), 0)
+
+	def remove(self, user:str, ip:str):
+		with self.lock: self.grants.pop((user, ip), None)
+
+	def restore(self, items:list):
+		''' Load items of another cache skipping
+			expired ones.
+		'''
+		now = time.time()
+		for (user, ip), expires in items:
+			if expires is not None and expires < now: continue
+			self.put(user, ip, expires)
+
+	def put(self, user:str, ip:str, expires:float=None):
+		''' expires - time.time() of expiration
+			or None if never.
+		'''
+		with self.lock:
+			self.grants.pop((user, ip), None)
+			self.grants[(user, ip)] = expires
+			if len(self.grants) <= self.size: return
+			now = time.time()
+			for key, exp in list(self.grants.items()):
+				if exp is not None and exp < now:
+					del self.grants[key]
+			while len(self.grants) > self.size:
+				del self.grants[next(iter(self.grants))]
+
+class TokenBuckets:
+	''' Token bucket per key: *rate* tokens per second
+		up to *burst* tokens. The least recently used
+		bucket is evicted when a shard holds more than its
+		share of *size*, whether it has filled up again or
+		not, so a flood of new keys can reset the limit of
+		a key that was not seen for a while.
+	'''
+	def __init__(self, rate:float, burst:float
+	, size:int=100_000, stripes:int=64):
+		self.rate = rate
+		self.burst = burst
+		self.size = size
+		self.shards = [(threading.Lock(), OrderedDict())
+			for _ in range(stripes)]
+
+	def __len__(self):
+		return sum(len(b) for _, b in self.shards)
+
+	def take(self, key)->bool:
+		''' Take a token for the key.
+			Return False if there are no tokens left.
+		'''
+		now = time.monotonic()
+		lock, buckets = self.shards[hash(key) % len(self.shards)]
+		with lock:
+			bucket = buckets.get(key)
+			if bucket is None:
+				buckets[key] = [self.burst - 1, now]
+				if len(buckets) > max(self.size // len(self.shards), 1):
+					buckets.popitem(last=False)
+				return True
+			buckets.move_to_end(key)
+			tokens = min(self.burst
+				, bucket[0] + (now - bucket[1]) * self.rate)
+			bucket[1] = now
+			if tokens < 1:
+				bucket[0] = tokens
+				return False
+			bucket[0] = tokens - 1
+			return True
+
+class RateLimiter:
+	''' Request rate limits per IP and per network
+		(/prefix for IPv4, /prefix6 for IPv6).
+		Rate 0 - no limit.
+	'''
+	def __init__(self, size:int=100_000):
+		self.size = size
+		self.ips = None
+		self.nets = None
+		self.prefix = 24
+		self.prefix6 = 64
+
+	def configure(self, rate:float, burst:float
+	, net_rate:float, net_burst:float
+	, prefix:int=24, prefix6:int=64):
+		''' Change limits. Buckets are kept if only
+			rates change.
+		'''
+		check_prefixes(prefix, prefix6)
+		self.ips = _buckets(self.ips, rate, burst, self.size)
+		if (prefix, prefix6) != (self.prefix, self.prefix6):
+			self.nets = None
+		self.nets = _buckets(self.nets, net_rate, net_burst, self.size)
+		self.prefix = prefix
+		self.prefix6 = prefix6
+
+	def take(self, ip:str)->str:
+		''' Count the request. Return 'ip' or 'network'
+			if the limit is exceeded, otherwise None.
+		'''
+		if self.ips is None and self.nets is None: return None
+		key = ip_key(ip)
+		if self.ips is not None and not self.ips.take(key):
+			return 'ip'
+		if self.nets is not None:
+			v6, num, bits = _split_key(key)
+			num >>= bits - (self.prefix6 if v6 else self.prefix)
+			if not self.nets.take((v6, num)): return 'network'
+		return None
+
+def _buckets(buckets:TokenBuckets, rate:float, burst:float
+, size:int)->TokenBuckets:
+	' Update the buckets or make new ones, None if rate is 0 '
+	if not rate: return None
+	burst = max(burst, 1)
+	if buckets is not None:
+		buckets.rate = rate
+		buckets.burst = burst
+		return buckets
+	return TokenBuckets(rate, burst, size)
+
+class ConnCounter:
+	''' Open connections in total and per IP '''
+	def __init__(self):
+		self.total = 0
+		self.ips = {}
+		self.lock = threading.Lock()
+
+	def open(self, ip:str, limit:int=0, ip_limit:int=0)->str:
+		''' Count the new connection unless it is over
+			a limit (0 - no limit).
+			Return 'connections' or 'ip_connections' if
+			it is, otherwise None.
+		'''
+		with self.lock:
+			if limit and self.total >= limit: return 'connections'
+			num = self.ips.get(ip, 0)
+			if ip_limit and num >= ip_limit: return 'ip_connections'
+			self.ips[ip] = num + 1
+			self.total += 1
+		return None
+
+	def close(self, ip:str):
+		with self.lock:
+			num = self.ips.pop(ip, 0)
+			if not num: return
+			if num > 1: self.ips[ip] = num - 1
+			self.total -= 1
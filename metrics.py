@@ -0,0 +1,137 @@
+import threading
+import time
+from bisect import bisect_left
+
+class Counter:
+	''' Counter with optional labels '''
+	kind = 'counter'
+
+	def __init__(self, name:str, help_text:str, labels:tuple=()):
+		self.name = name
+		self.help_text = help_text
+		self.labels = labels
+		self.values = {}
+		self.lock = threading.Lock()
+
+	def inc(self, *label_values, value:float=1):
+		with self.lock:
+			self.values[label_values] = \
+				self.values.get(label_values, 0) + value
+
+	def lines(self)->list:
+		with self.lock: values = list(self.values.items())
+		return [
+			f'{self.name}{_labels(self.labels, lv)} {v}'
+				for lv, v in values
+		]
+
+class Gauge:
+	''' Value taken from *func* at the time of scraping.
+		func may return a number or a dict with tuples of
+		label values as keys.
+	'''
+	kind = 'gauge'
+
+	def __init__(self, name:str, help_text:str, func
+	, labels:tuple=(), kind:str='gauge'):
+		self.name = name
+		self.help_text = help_text
+		self.func = func
+		self.labels = labels
+		self.kind = kind
+
+	def lines(self)->list:
+		value = self.func()
+		if not isinstance(value, dict): value = {(): value}
+		return [
+			f'{self.name}{_labels(self.labels, lv)} {v}'
+				for lv, v in value.items()
+		]
+
+class Histogram:
+	''' Histogram with fixed buckets (seconds) '''
+	kind = 'histogram'
+	BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05
+		, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+	def __init__(self, name:str, help_text:str
+	, buckets:tuple=BUCKETS):
+		self.name = name
+		self.help_text = help_text
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.total = 0.0
+		self.lock = threading.Lock()
+
+	def observe(self, value:float):
+		i = bisect_left(self.buckets, value)
+		with self.lock:
+			self.counts[i] += 1
+			self.total += value
+
+	def time(self):
+		' Context manager to observe the time of the block '
+		return _Timer(self)
+
+	def lines(self)->list:
+		with self.lock:
+			counts = self.counts[:]
+			total = self.total
+		lines = []
+		acc = 0
+		for le, num in zip((*self.buckets, '+Inf'), counts):
+			acc += num
+			lines.append(f'{self.name}_bucket{{le="{le}"}} {acc}')
+		lines.append(f'{self.name}_sum {total}')
+		lines.append(f'{self.name}_count {acc}')
+		return lines
+
+class _Timer:
+	__slots__ = ('hist', 'start')
+
+	def __init__(self, hist:Histogram):
+		self.hist = hist
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *args):
+		self.hist.observe(time.perf_counter() - self.start)
+
+class Registry:
+	''' Set of metrics rendered in the Prometheus
+		text format.
+	'''
+	def __init__(self):
+		self.metrics = []
+
+	def add(self, metric):
+		self.metrics.append(metric)
+		return metric
+
+	def counter(self, *args, **kwargs)->Counter:
+		return self.add(Counter(*args, **kwargs))
+
+	def gauge(self, *args, **kwargs)->Gauge:
+		return self.add(Gauge(*args, **kwargs))
+
+	def histogram(self, *args, **kwargs)->Histogram:
+		return self.add(Histogram(*args, **kwargs))
+
+	def render(self)->str:
+		lines = []
+		for m in self.metrics:
+			lines.append(f'# HELP {m.name} {m.help_text}')
+			lines.append(f'# TYPE {m.name} {m.kind}')
+			try:
+				lines.extend(m.lines())
+			except Exception as e:
+				lines.append(f'# error: {e!r}')
+		return '\n'.join(lines) + '\n'
+
+def _labels(names:tuple, values:tuple)->str:
+	if not names: return ''
+	return '{' + ','.join(
+		f'{n}="{v}"' for n, v in zip(names, values)
+	) + '}'
@@ -16,6 +16,7 @@ time_capt=Time
 ip_capt=Your IP
 page_title=Knock-knock
 access_error=You are logged in as «{}»<br>There is some error :(
+access_pending=You are logged in as «{}»<br>Access will be granted in a few seconds
 pass_expired=You are logged in as «{}»<br>Your passcode has expired: {}
 pass_unknown=Unknown passcode
 ban=Ban
@@ -30,6 +31,7 @@ time_capt=Время
 ip_capt=Ваш IP
 page_title=Тук-тук
 access_error=Вы вошли как «{}»<br>Какая-то ошибка включения доступа :(
+access_pending=Вы вошли как «{}»<br>Доступ будет открыт через несколько секунд
 pass_expired=Вы вошли как «{}»<br>Ваш код доступа уже истёк: {}
 pass_unknown=Неизвестный код доступа
 ban=Бан
@@ -1,5 +1,10 @@
 import sys, binascii, socket, select, ssl
 import hashlib
+import re
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from contextlib import contextmanager
 
 class ApiRos:
 	"Routeros api"
@@ -7,6 +12,8 @@ class ApiRos:
 		self.sk = sk
 		self.currenttag = 0
 		self.print_debug = print_debug
+		self.rbuf = bytearray()
+		self.rpos = 0
 	
 	def d_print(self, msg:str):
 		if not self.print_debug: return
@@ -34,26 +41,66 @@ class ApiRos:
 		if self.writeSentence(words) == 0: return
 		r = []
 		while 1:
-			i = self.readSentence()
-			if len(i) == 0: continue
-			reply = i[0]
-			attrs = {}
-			for w in i[1:]:
-				j = w.find('=', 1)
-				if (j == -1):
-					attrs[w] = ''
-				else:
-					attrs[w[:j]] = w[j+1:]
+			reply, attrs = self.readReply()
 			r.append((reply, attrs))
 			if reply == '!done': return r
 
+	def stream(self, words):
+		''' Send sentence and yield replies one by one
+			as they are read, up to the '!done'.
+		'''
+		if self.writeSentence(words) == 0: return
+		while 1:
+			reply, attrs = self.readReply()
+			if reply == '!fatal':
+				raise RuntimeError('fatal: '
+					+ attrs.get('=message', 'connection closed'))
+			yield reply, attrs
+			if reply == '!done': return
+
+	def readReply(self)->tuple:
+		''' Read next non-empty sentence and split it
+			to (reply, {'=attr': 'value'}).
+		'''
+		while 1:
+			i = self.readSentence()
+			if len(i): break
+		attrs = {}
+		for w in i[1:]:
+			j = w.find('=', 1)
+			if (j == -1):
+				attrs[w] = ''
+			else:
+				attrs[w[:j]] = w[j+1:]
+		return i[0], attrs
+
+	def talk_many(self, sentences:list)->list:
+		''' Send several sentences at once as a pipeline
+			and return list of replies in the same order.
+			Every sentence is tagged so replies are matched
+			by the tag and not by the order.
+		'''
+		for tag, words in enumerate(sentences):
+			self.writeSentence([*words, f'.tag={tag}'])
+		r = [[] for _ in sentences]
+		left = len(sentences)
+		while left:
+			reply, attrs = self.readReply()
+			if reply == '!fatal':
+				raise RuntimeError('fatal: '
+					+ attrs.get('=message', 'connection closed'))
+			tag = int(attrs.pop('.tag', -1))
+			if not 0 <= tag < len(r): continue
+			r[tag].append((reply, attrs))
+			if reply == '!done': left -= 1
+		return r
+
 	def writeSentence(self, words):
-		ret = 0
-		for w in words:
-			self.writeWord(w)
-			ret += 1
-		self.writeWord('')
-		return ret
+		if self.print_debug:
+			for w in words: self.d_print("<<< " + w)
+			self.d_print("<<< ")
+		self.sk.sendall(encode_sentence(words))
+		return len(words)
 
 	def readSentence(self):
 		r = []
@@ -69,7 +116,7 @@ class ApiRos:
 
 	def readWord(self):
 		ret = self.readStr(self.readLen())
-		self.d_print((">>> " + ret))
+		if self.print_debug: self.d_print((">>> " + ret))
 		return ret
 
 	def writeLen(self, l):
@@ -99,35 +146,26 @@ class ApiRos:
 			self.writeByte((l & 0xFF).to_bytes(1, sys.byteorder))
 
 	def readLen(self):
-		c = ord(self.readStr(1))
+		if self.rpos >= len(self.rbuf): self._fill(1)
+		c = self.rbuf[self.rpos]
 		if (c & 0x80) == 0x00:
-			pass
+			self.rpos += 1
+			return c
 		elif (c & 0xC0) == 0x80:
-			c &= ~0xC0
-			c <<= 8
-			c += ord(self.readStr(1))
+			size, mask = 2, 0x3FFF
 		elif (c & 0xE0) == 0xC0:
-			c &= ~0xE0
-			c <<= 8
-			c += ord(self.readStr(1))
-			c <<= 8
-			c += ord(self.readStr(1))
+			size, mask = 3, 0x1FFFFF
 		elif (c & 0xF0) == 0xE0:
-			c &= ~0xF0
-			c <<= 8
-			c += ord(self.readStr(1))
-			c <<= 8
-			c += ord(self.readStr(1))
-			c <<= 8
-			c += ord(self.readStr(1))
+			size, mask = 4, 0xFFFFFFF
 		elif (c & 0xF8) == 0xF0:
-			c = ord(self.readStr(1))
-			c <<= 8
-			c += ord(self.readStr(1))
-			c <<= 8
-			c += ord(self.readStr(1))
-			c <<= 8
-			c += ord(self.readStr(1))
+			size, mask = 5, 0xFFFFFFFF
+		else:
+			raise RuntimeError(f"unknown control byte: {c:#x}")
+		self._fill(size)
+		c = int.from_bytes(
+			self.rbuf[self.rpos:self.rpos + size], 'big'
+		) & mask
+		self.rpos += size
 		return c
 
 	def writeStr(self, str):
@@ -145,14 +183,89 @@ class ApiRos:
 			n += r
 
 	def readStr(self, length):
-		ret = ''
-		while len(ret) < length:
-			s = self.sk.recv(length - len(ret))
+		if not length: return ''
+		self._fill(length)
+		start = self.rpos
+		self.rpos += length
+		with memoryview(self.rbuf) as mv:
+			return str(mv[start:self.rpos], 'utf-8', 'replace')
+
+	def buffered(self)->int:
+		' Number of received but not yet read bytes '
+		return len(self.rbuf) - self.rpos
+
+	def _fill(self, length):
+		' Read from the socket until *length* bytes are buffered '
+		if self.rpos and self.rpos == len(self.rbuf):
+			self.rbuf.clear()
+			self.rpos = 0
+		while len(self.rbuf) - self.rpos < length:
+			if self.rpos:
+				del self.rbuf[:self.rpos]
+				self.rpos = 0
+			s = self.sk.recv(max(length - len(self.rbuf), 0x10000))
 			if s == b'': raise RuntimeError("connection closed by remote end")
-			if s >= (128).to_bytes(1, "big") :
-			   return s
-			ret += s.decode(sys.stdout.encoding, "replace")
-		return ret
+			self.rbuf += s
+
+def encode_length(l:int)->bytes:
+	''' Length prefix of the word '''
+	if l < 0x80:
+		return l.to_bytes(1, 'big')
+	elif l < 0x4000:
+		return (l | 0x8000).to_bytes(2, 'big')
+	elif l < 0x200000:
+		return (l | 0xC00000).to_bytes(3, 'big')
+	elif l < 0x10000000:
+		return (l | 0xE0000000).to_bytes(4, 'big')
+	else:
+		return b'\xF0' + l.to_bytes(4, 'big')
+
+def encode_sentence(words)->bytearray:
+	''' Whole sentence with length prefixes
+		and the terminating empty word.
+	'''
+	buf = bytearray()
+	for w in words:
+		b = w.encode('utf-8')
+		l = len(b)
+		if l < 0x80:
+			buf.append(l)
+		else:
+			buf += encode_length(l)
+		buf += b
+	buf.append(0)
+	return buf
+
+RE_TIME_UNITS = re.compile(r'(\d+)(ms|[wdhms])')
+RE_CLOCK = re.compile(r'(.*?)(\d+):(\d+):(\d+(?:\.\d+)?)')
+TIME_UNITS = {
+	'w' : 604800
+	, 'd' : 86400
+	, 'h' : 3600
+	, 'm' : 60
+	, 's' : 1
+	, 'ms' : 0.001
+}
+
+def ros_timeout(text:str)->float:
+	''' Convert RouterOS time like '7d 00:00:00'
+		, '6d23:59:58', '08:00:00' or '1w2d3h4m5s'
+		to seconds.
+	'''
+	sec = 0
+	for part in str(text).split():
+		if ':' in part:
+			clock = RE_CLOCK.fullmatch(part)
+			if not clock: raise ValueError(f'wrong time: {text}')
+			part, h, m, s = clock.groups()
+			sec += int(h) * 3600 + int(m) * 60 + float(s)
+			if not part: continue
+		if part.isdigit():
+			sec += int(part)
+		else:
+			for num, unit in RE_TIME_UNITS.findall(part):
+				sec += int(num) * TIME_UNITS[unit]
+	return sec
 
 def open_socket(dst, port, secure=False):
 	s = None
@@ -194,8 +307,9 @@ def main():
 	inputsentence = []
 
 	while 1:
-		r = select.select([s, sys.stdin], [], [], None)
-		if s in r[0]:
+		r = select.select([s, sys.stdin], [], []
+			, 0 if apiros.buffered() else None)
+		if s in r[0] or apiros.buffered():
 			x = apiros.readSentence()
 
 		if sys.stdin in r[0]:
@@ -245,5 +359,282 @@ def rosapi_send(ip:str, port:int
 	except Exception as e:
 		return False, repr(e)
 
+def connect(ip:str, port:int, username:str, password:str
+, secure:bool=True, timeout:float=None
+, print_debug:bool=False)->ApiRos:
+	''' Open a socket to the device and log in.
+		Return ApiRos instance or raise an exception.
+	'''
+	(af, socktype, proto
+	, canonname, sockaddr) = socket.getaddrinfo(
+		ip
+		, port
+		, socket.AF_UNSPEC
+		, socket.SOCK_STREAM
+	)[0]
+	soc = socket.socket(af, socktype, proto)
+	soc.settimeout(timeout)
+	try:
+		if secure:
+			ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+			ctx.check_hostname = False
+			ctx.verify_mode = ssl.CERT_NONE
+			ctx.set_ciphers('ADH:@SECLEVEL=0')
+			soc = ctx.wrap_socket(soc)
+		soc.connect(sockaddr)
+		apiros = ApiRos(soc, print_debug)
+		if not apiros.login(username, password):
+			raise RuntimeError('login failed')
+	except:
+		soc.close()
+		raise
+	return apiros
+
+class RosPool:
+	''' Pool of authenticated RouterOS API sessions.
+		Sessions are opened on demand (no more than *size*
+		at once) and kept open between commands.
+		A session that was idle longer than *check_idle*
+		seconds is checked with a cheap command before use.
+		If a command fails on a reused session, the session
+		is dropped and the command is repeated once on a
+		fresh one.
+		timer - optional function that gets the round
+		trip time of every command in seconds.
+	'''
+	CHECK_CMD = ['/system/identity/print']
+
+	def __init__(self, ip:str, port:int
+	, username:str, password:str, secure:bool=True
+	, size:int=2, timeout:float=10, check_idle:float=60
+	, print_debug:bool=False):
+		self.args = {
+			'ip' : ip
+			, 'port' : port
+			, 'username' : username
+			, 'password' : password
+			, 'secure' : secure
+			, 'timeout' : timeout
+			, 'print_debug' : print_debug
+		}
+		self.check_idle = check_idle
+		self.idle = []
+		self.lock = threading.Lock()
+		self.slots = threading.BoundedSemaphore(max(size, 1))
+		self.closed = False
+		self.connects = 0
+		self.reconnects = 0
+		self.errors = 0
+		self.timer = None
+
+	def acquire(self)->tuple:
+		''' Take an idle session or open a new one.
+			Return (ApiRos, is_reused).
+		'''
+		self.slots.acquire()
+		try:
+			while True:
+				with self.lock:
+					if not self.idle: break
+					apiros, last_use = self.idle.pop()
+				if time.monotonic() - last_use < self.check_idle:
+					return apiros, True
+				try:
+					apiros.talk(self.CHECK_CMD)
+					return apiros, True
+				except Exception:
+					self.reconnects += 1
+					self._close(apiros)
+			apiros = connect(**self.args)
+			self.connects += 1
+			return apiros, False
+		except:
+			self.slots.release()
+			raise
+
+	def release(self, apiros:ApiRos, broken:bool=False):
+		''' Return session to the pool or close it
+			if it is *broken*.
+		'''
+		try:
+			if broken or self.closed:
+				self._close(apiros)
+			else:
+				with self.lock:
+					self.idle.append((apiros, time.monotonic()))
+		finally:
+			self.slots.release()
+
+	def send(self, cmd:list)->tuple:
+		''' Send command via pooled session.
+			Return (True, data) on success
+			or (False, error text).
+		'''
+		for attempt in (1, 2):
+			try:
+				apiros, reused = self.acquire()
+			except Exception as e:
+				self.errors += 1
+				return False, repr(e)
+			try:
+				start = time.perf_counter()
+				r = apiros.talk(cmd)
+				if self.timer: self.timer(time.perf_counter() - start)
+			except Exception as e:
+				self.release(apiros, broken=True)
+				if reused and attempt == 1:
+					self.reconnects += 1
+					continue
+				self.errors += 1
+				return False, repr(e)
+			self.release(apiros)
+			return True, r
+
+	def send_many(self, cmds:list)->tuple:
+		''' Send several commands via one pooled session.
+			Return (True, [data1, data2...]) on success
+			or (False, error text).
+		'''
+		for attempt in (1, 2):
+			try:
+				apiros, reused = self.acquire()
+			except Exception as e:
+				self.errors += 1
+				return False, repr(e)
+			try:
+				start = time.perf_counter()
+				r = apiros.talk_many(cmds)
+				if self.timer: self.timer(time.perf_counter() - start)
+			except Exception as e:
+				self.release(apiros, broken=True)
+				if reused and attempt == 1:
+					self.reconnects += 1
+					continue
+				self.errors += 1
+				return False, repr(e)
+			self.release(apiros)
+			return True, r
+
+	@contextmanager
+	def session(self):
+		''' Pooled session for a long conversation.
+			The session is closed on exception.
+		'''
+		apiros, _ = self.acquire()
+		try:
+			yield apiros
+		except:
+			self.release(apiros, broken=True)
+			raise
+		self.release(apiros)
+
+	def close(self):
+		''' Close all idle sessions. Busy sessions
+			are closed when they are released.
+		'''
+		self.closed = True
+		with self.lock:
+			idle, self.idle = self.idle, []
+		for apiros, _ in idle: self._close(apiros)
+
+	@staticmethod
+	def _close(apiros:ApiRos):
+		try:
+			apiros.sk.close()
+		except Exception:
+			pass
+
+def address_list(pool:RosPool, list_name:str
+, props:str='address,timeout,comment,disabled'):
+	''' Yield entries (dicts like {'=address': '1.2.3.4'})
+		of the firewall address list as they are read
+		from the device.
+	'''
+	cmd = [
+		'/ip/firewall/address-list/print'
+		, '=.proplist=' + props
+		, '?list=' + list_name
+	]
+	with pool.session() as apiros:
+		for reply, attrs in apiros.stream(cmd):
+			if reply == '!re':
+				yield attrs
+			elif reply == '!trap':
+				raise RuntimeError(
+					attrs.get('=message', 'unknown error'))
+
+class RosBatcher:
+	''' Collects commands for *window* seconds (or until
+		there are *size* of them) and sends them to the
+		device via *pool* as one pipeline.
+	'''
+	def __init__(self, pool:RosPool, window:float=0.05
+	, size:int=50):
+		self.pool = pool
+		self.window = window
+		self.size = max(size, 1)
+		self.pending = []
+		self.cond = threading.Condition()
+		self.closed = False
+		self.batches = 0
+		threading.Thread(target=self._worker, daemon=True).start()
+
+	def submit(self, cmd:list)->Future:
+		''' Queue command. Result of the future
+			is the same as for *RosPool.send*.
+			A closed batcher sends the command at once
+			via the pool.
+		'''
+		fut = Future()
+		with self.cond:
+			closed = self.closed
+			if not closed: self.pending.append((cmd, fut))
+			if len(self.pending) == 1 \
+			or len(self.pending) >= self.size:
+				self.cond.notify()
+		if closed: fut.set_result(self.pool.send(cmd))
+		return fut
+
+	def send(self, cmd:list, timeout:float=None)->tuple:
+		''' Queue command and wait for the answer no
+			longer than *timeout* seconds (by default
+			enough for a reconnect and a retry).
+		'''
+		if timeout is None:
+			timeout = self.window + 3 * self.pool.args['timeout']
+		try:
+			return self.submit(cmd).result(timeout)
+		except FutureTimeout:
+			return False, 'batcher timeout'
+
+	def close(self):
+		''' Stop the worker when the queue is empty. '''
+		with self.cond:
+			self.closed = True
+			self.cond.notify()
+
+	def _worker(self):
+		while True:
+			with self.cond:
+				while not self.pending:
+					if self.closed: return
+					self.cond.wait()
+				deadline = time.monotonic() + self.window
+				while len(self.pending) < self.size:
+					left = deadline - time.monotonic()
+					if left <= 0: break
+					self.cond.wait(left)
+				batch = self.pending[:self.size]
+				del self.pending[:self.size]
+			self.batches += 1
+			status, data = self.pool.send_many(
+				[cmd for cmd, _ in batch]
+			)
+			for num, (_, fut) in enumerate(batch):
+				if status:
+					fut.set_result((True, data[num]))
+				else:
+					fut.set_result((False, data))
+
 if __name__ == '__main__':
-	main()
\ No newline at end of file
+	main()
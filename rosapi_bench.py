@@ -0,0 +1,296 @@
+''' Benchmarks and property checks of the RouterOS API codec.
+	- round trip of lengths in every size class
+	and of words and sentences through ApiRos;
+	- encode/decode throughput of address-list
+	add and print sentences;
+	- fuzzing of the reader with random and truncated
+	input;
+	- replay of replies captured from the fake device
+	(fake_ros.py).
+	Usage:
+		python rosapi_bench.py [number of sentences]
+'''
+import random
+import socket
+import sys
+import time
+from rosapi import ApiRos, encode_length, encode_sentence
+from fake_ros import FakeRos
+
+SENTENCE_ADD = [
+	'/ip/firewall/address-list/add'
+	, '=list=KNOCKING_BLACK'
+	, '=address=203.0.113.25'
+	, '=comment=web_knocking_threshold_exceed'
+	, '=timeout=7d 00:00:00'
+	, '.tag=12'
+]
+SENTENCE_RE = [
+	'!re'
+	, '=.id=*1A2B'
+	, '=list=KNOCKING_WHITE'
+	, '=address=198.51.100.77'
+	, '=creation-time=oct/18/2026 12:00:00'
+	, '=timeout=6d23:59:58'
+	, '=dynamic=true'
+	, '=disabled=false'
+	, '=comment=web_knocking_permanent_Ye7gfV'
+]
+# (first, last) length of every size class
+LEN_CLASSES = (
+	(0, 0x7F)
+	, (0x80, 0x3FFF)
+	, (0x4000, 0x1FFFFF)
+	, (0x200000, 0xFFFFFFF)
+	, (0x10000000, 0xFFFFFFFF)
+)
+# Words are checked up to this length, longer ones
+# only by their length prefix:
+WORD_MAX_LEN = 0x200000
+
+class CountingSocket:
+	''' Socket replacement that only counts calls and bytes '''
+	def __init__(self):
+		self.calls = 0
+		self.size = 0
+		self.data = bytearray()
+		self.keep = False
+
+	def send(self, data):
+		self.calls += 1
+		self.size += len(data)
+		if self.keep: self.data += data
+		return len(data)
+
+	def sendall(self, data):
+		self.send(data)
+
+class BufferSocket:
+	''' Socket replacement that returns *data* from recv()
+		in chunks of random size up to *chunk*, then b''.
+	'''
+	def __init__(self, data:bytes, chunk:int=0x10000
+	, seed:int=0):
+		self.data = memoryview(bytes(data))
+		self.pos = 0
+		self.chunk = chunk
+		self.rnd = random.Random(seed)
+
+	def recv(self, size:int)->bytes:
+		size = min(size, self.rnd.randint(1, self.chunk))
+		chunk = self.data[self.pos:self.pos + size]
+		self.pos += len(chunk)
+		return bytes(chunk)
+
+class RecordingSocket:
+	''' Socket wrapper that keeps all received bytes '''
+	def __init__(self, sk:socket.socket):
+		self.sk = sk
+		self.received = bytearray()
+
+	def recv(self, size:int)->bytes:
+		data = self.sk.recv(size)
+		self.received += data
+		return data
+
+	def sendall(self, data):
+		self.sk.sendall(data)
+
+def write_per_byte(apiros:ApiRos, words:list):
+	''' The old path: one send() per length byte and per word '''
+	for w in words: apiros.writeWord(w)
+	apiros.writeWord('')
+
+def reader(data:bytes, chunk:int=0x10000, seed:int=0)->ApiRos:
+	return ApiRos(BufferSocket(data, chunk, seed))
+
+def check_lengths(rnd:random.Random)->int:
+	''' Every size class: the bounds and random lengths
+		are decoded back, the prefix has the expected size
+		and matches the old writeLen().
+		Returns number of checked lengths.
+	'''
+	num = 0
+	for size, (first, last) in enumerate(LEN_CLASSES, 1):
+		lengths = [first, last] + [
+			rnd.randint(first, last) for _ in range(200)]
+		for l in lengths:
+			prefix = encode_length(l)
+			assert len(prefix) == size, (l, prefix)
+			apiros = reader(prefix, chunk=1)
+			assert apiros.readLen() == l, (l, prefix)
+			assert apiros.buffered() == 0, (l, prefix)
+			sk = CountingSocket()
+			sk.keep = True
+			ApiRos(sk).writeLen(l)
+			assert sk.data == prefix, (l, prefix, sk.data)
+			num += 1
+	return num
+
+def check_words(rnd:random.Random)->int:
+	''' Words of the first size classes survive encoding
+		and reading, including multibyte characters and
+		reads split across recv() calls.
+		Returns number of checked words.
+	'''
+	num = 0
+	for first, last in LEN_CLASSES:
+		if first > WORD_MAX_LEN: break
+		last = min(last, WORD_MAX_LEN)
+		first = max(first, 1)
+		for l in (first, last, rnd.randint(first, last)):
+			word = 'w' * l
+			words = [word, '=a=' + 'я' * (l // 8)]
+			data = encode_sentence(words)
+			for chunk in (1, 7, 0x10000):
+				if chunk == 1 and l > 0x4000: continue
+				apiros = reader(data, chunk, seed=l)
+				assert apiros.readSentence() == words, (l, chunk)
+				assert apiros.buffered() == 0, (l, chunk)
+			num += 1
+	for _ in range(300):
+		words = [
+			''.join(rnd.choice('ab=!.я😀 ')
+				for _ in range(rnd.randint(1, 200)))
+			for _ in range(rnd.randint(0, 10))
+		]
+		data = encode_sentence(words)
+		assert reader(data, 13, seed=num).readSentence() \
+			== words, words
+		num += 1
+	return num
+
+def fuzz(rnd:random.Random, corpus:list, number:int=2000)->dict:
+	''' Feed random bytes, cut and mutated sentences to
+		the reader. It must either parse them or raise
+		RuntimeError, nothing else.
+		Returns counters of outcomes.
+	'''
+	stats = {'parsed': 0, 'rejected': 0}
+	for n in range(number):
+		kind = n % 3
+		if kind == 0:
+			data = bytes(rnd.randrange(256)
+				for _ in range(rnd.randint(0, 64)))
+		else:
+			data = bytearray(rnd.choice(corpus))
+			if kind == 1:
+				data = data[:rnd.randrange(len(data))]
+			else:
+				for _ in range(rnd.randint(1, 4)):
+					data[rnd.randrange(len(data))] = rnd.randrange(256)
+		apiros = reader(data, rnd.randint(1, 16), seed=n)
+		try:
+			while apiros.buffered() or apiros.sk.pos < len(data):
+				apiros.readReply()
+			stats['parsed'] += 1
+		except RuntimeError:
+			stats['rejected'] += 1
+	return stats
+
+def capture()->list:
+	''' Talk to the fake device and return list of
+		(raw reply bytes, parsed replies, ordered) for
+		some commands. Replies of a pipeline are not
+		ordered.
+	'''
+	dev = FakeRos()
+	port = dev.start()
+	sk = RecordingSocket(socket.create_connection(('127.0.0.1', port)))
+	apiros = ApiRos(sk)
+	cmds = [
+		['/login', '=name=admin', '=password=admin']
+		, ['/system/identity/print']
+		, *(
+			['/ip/firewall/address-list/add', '=list=KNOCKING_BLACK'
+			, f'=address=203.0.113.{n}', '=timeout=7d 00:00:00'
+			, '=comment=web_knocking_port scan']
+				for n in range(1, 30)
+		)
+		, ['/ip/firewall/address-list/add', '=list=KNOCKING_BLACK'
+			, '=address=203.0.113.1']
+		, ['/ip/firewall/address-list/print', '?list=KNOCKING_BLACK']
+		, ['/no/such/command']
+	]
+	captured = []
+	for cmd in cmds:
+		start = len(sk.received)
+		replies = apiros.talk(cmd)
+		captured.append((bytes(sk.received[start:]), replies, True))
+	start = len(sk.received)
+	replies = apiros.talk_many(cmds[2:6])
+	captured.append((bytes(sk.received[start:])
+		, [r for rs in replies for r in rs], False))
+	sk.sk.close()
+	dev.stop()
+	return captured
+
+def replay(captured:list)->int:
+	''' Captured replies read byte by byte and in chunks
+		give the same result as the live session.
+		Returns number of replayed sentences.
+	'''
+	num = 0
+	for data, replies, ordered in captured:
+		for chunk in (1, 5, 0x10000):
+			apiros = reader(data, chunk)
+			got = []
+			while apiros.buffered() or apiros.sk.pos < len(data):
+				reply, attrs = apiros.readReply()
+				attrs.pop('.tag', None)
+				got.append((reply, attrs))
+			expected = [(r, {k: v for k, v in a.items()
+				if k != '.tag'}) for r, a in replies]
+			if not ordered:
+				got.sort(key=repr)
+				expected.sort(key=repr)
+			assert got == expected, (data, got, expected)
+			num += len(got)
+	return num
+
+def bench(name:str, func, number:int):
+	sk = CountingSocket()
+	apiros = ApiRos(sk)
+	start = time.perf_counter()
+	for _ in range(number): func(apiros, SENTENCE_ADD)
+	elapsed = time.perf_counter() - start
+	print('{:<12}{:>10.2f} us/sentence{:>8.1f} sends/sentence{:>8} bytes'
+		.format(
+			name
+			, elapsed / number * 1e6
+			, sk.calls / number
+			, sk.size // number
+		)
+	)
+
+def bench_read(name:str, words:list, number:int):
+	data = encode_sentence(words) * number
+	apiros = reader(data)
+	start = time.perf_counter()
+	for _ in range(number): apiros.readReply()
+	elapsed = time.perf_counter() - start
+	print('{:<12}{:>10.2f} us/sentence{:>8.1f} MB/s'.format(
+		name
+		, elapsed / number * 1e6
+		, len(data) / elapsed / 2**20
+	))
+
+def main():
+	number = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+	rnd = random.Random(1)
+	print(f'lengths: {check_lengths(rnd)} OK')
+	print(f'words: {check_words(rnd)} OK')
+	captured = capture()
+	print(f'replay: {replay(captured)} sentences OK')
+	corpus = [encode_sentence(SENTENCE_ADD), encode_sentence(SENTENCE_RE)]
+	corpus.extend(c[0] for c in captured if c[0])
+	stats = fuzz(rnd, corpus)
+	print('fuzz: ' + ', '.join(f'{k}: {v}' for k, v in stats.items()))
+	print(f'\nWrite {number} address-list/add sentences:')
+	bench('per-byte', write_per_byte, number)
+	bench('buffered', ApiRos.writeSentence, number)
+	print(f'\nRead {number} sentences:')
+	bench_read('add', SENTENCE_ADD, number)
+	bench_read('print !re', SENTENCE_RE, number)
+
+if __name__ == '__main__': main()
@@ -1,15 +1,27 @@
 
 import configparser
+import asyncio
+import atexit
+import pickle
+import signal
 import threading
 import time
+import queue
+from concurrent.futures import Future, TimeoutError as FutureTimeout
 from http.server import BaseHTTPRequestHandler \
 	, ThreadingHTTPServer
 import os
+import socket
+import string
+import struct
+from email.utils import formatdate
 from operator import itemgetter
 from datetime import datetime as dt, timedelta
-from socket import inet_aton
 import resources
-from rosapi import rosapi_send
+from rosapi import RosPool, RosBatcher, ros_timeout, address_list
+from ip_state import IpTable, Stripes, GrantCache, PrefixSet \
+	, NetAggregator, RateLimiter, ConnCounter, ip_key, check_prefixes
+from metrics import Registry
 from easy_logging import EasyLogging
 if os.name == 'nt':
 	import ctypes
@@ -20,20 +32,26 @@ if os.name == 'nt':
 TITLE = 'Web Knocking'
 APP_VERSION = 'v2022-01-03'
 INI_FILE = 'web_knocking.ini'
+HTML_FILE = 'files/index.html'
+FAVICON_FILE = 'files/favicon.png'
 DEF_DEVICE_TYPE = 'mikrotik_routeros'
 PASS_SEP = '_'
+PAGE_FIELDS = ('message', 'ip_address', 'timestamp')
+TOO_MANY_REQUESTS = (
+	b'HTTP/1.0 429 Too Many Requests\r\n'
+	+ b'Content-type: text/plain\r\n'
+	+ b'Content-Length: 17\r\n'
+	+ b'Retry-After: 1\r\n'
+	+ b'Connection: close\r\n\r\n'
+	+ b'Too many requests'
+)
+RAW_PATHS = {
+	'/status' : 'text/html; charset=utf-8'
+	, '/metrics' : 'text/plain; version=0.0.4; charset=utf-8'
+}
 
 event_counter = 0
 sett = None
-{
-	'1.2.3.4' : {
-		'ip' : '1.2.3.4'
-		, 'counter' : 0
-		, 'status' : 'good'
-		, 'reason' : 'white'
-		, 'user' : 'John'
-	}
-}
 {
 	'John' : {
 		'name': 'John'
@@ -42,6 +60,9 @@ sett = None
 		, 'last_day' : dt(
 			2020, 4, 20
 		)
+		, 'expires' : dt(
+			2020, 4, 21
+		)
 		, 'ips': [
 			'10.0.1.3'
 			, '10.0.8.4'
@@ -50,13 +71,42 @@ sett = None
 }
 log = None
 lang = None
+outbox = None
+user_locks = Stripes()
+sync_now = threading.Event()
+reload_lock = threading.Lock()
+connections = ConnCounter()
+metrics = Registry()
+m_requests = metrics.counter('knock_requests_total'
+	, 'HTTP requests by path', ('path',))
+m_rejected = metrics.counter('knock_rejected_total'
+	, 'Connections dropped before reading the request', ('reason',))
+m_decision = metrics.histogram('knock_decision_seconds'
+	, 'Time of decision()')
+m_push = metrics.histogram('knock_push_seconds'
+	, 'Time from queuing an address to the device answer')
+m_rosapi = metrics.histogram('knock_rosapi_seconds'
+	, 'Round trip of a RouterOS API command or batch')
+m_push_errors = metrics.counter('knock_push_errors_total'
+	, 'Failed pushes to the device')
 
 DEF_OPT_GENERAL = [
 	('developer', False)
 	, ('language', 'en')
 	, ('port', 80)
+	, ('server', 'threading')
+	, ('read_timeout', 10)
+	, ('header_timeout', 15)
+	, ('max_connections', 500)
+	, ('max_ip_connections', 10)
 	, ('perm_timeout', '7d 00:00:00')
 	, ('temp_timeout', '08:00:00')
+	, ('black_timeout', '')
+	, ('grey_timeout', '1d 00:00:00')
+	, ('ip_table_size', 100_000)
+	, ('sync_interval', '00:10:00')
+	, ('snapshot', 'web_knocking.state')
+	, ('snapshot_interval', '00:05:00')
 	, ('cmd', '/ip firewall address-list add'
 			+ ' list={list_name} address={ip}'
 			+ ' comment={comment}'
@@ -65,9 +115,27 @@ DEF_OPT_GENERAL = [
 	, ('white_list', 'KNOCKING_WHITE')
 	, ('black_list', 'KNOCKING_BLACK')
 	, ('black_threshold', 3)
+	, ('black_window', '01:00:00')
+	, ('black_net_threshold', 0)
+	, ('black_net_prefix', 24)
+	, ('black_net_prefix6', 64)
+	, ('black_net_window', '01:00:00')
 	, ('safe_hosts', ['127.0.0.1'])
 	, ('url_prefix', 'http://localhost/')
 	, ('log_file', False)
+	, ('log_max_size', 100)
+	, ('log_keep_files', 100)
+	, ('log_keep_size', 2000)
+	, ('outbox_size', 1000)
+	, ('grant_wait', 3000)
+	, ('grant_refresh', '01:00:00')
+	, ('watch_interval', '00:00:02')
+	, ('rate_limit', 5)
+	, ('rate_burst', 20)
+	, ('rate_net_limit', 50)
+	, ('rate_net_burst', 200)
+	, ('rate_prefix', 24)
+	, ('rate_prefix6', 64)
 ]
 DEF_OPT_DEVICE = [
 	('device_type', DEF_DEVICE_TYPE)
@@ -75,6 +143,11 @@ DEF_OPT_DEVICE = [
 	, ('username', 'admin')
 	, ('password', 'admin')
 	, ('secure', True)
+	, ('pool_size', 2)
+	, ('timeout', 10)
+	, ('check_idle', 60)
+	, ('batch_window', 50)
+	, ('batch_size', 50)
 ]
 
 def set_title(add_to_title:str=''):
@@ -160,27 +233,29 @@ def netmiko_send(cmd, debug:bool=False):
 	return True, result
 
 
+def ros_cmd(ip:str, list_name:str=''
+, comment:str='', timeout:str='')->list:
+	''' RouterOS API sentence to add IP to the list '''
+	cmd = [
+			'/ip/firewall/address-list/add'
+			, '=list=' + list_name
+			, '=address=' + ip
+	]
+	if timeout: cmd.append('=timeout=' + timeout)
+	if comment: cmd.append('=comment=' + comment)
+	return cmd
+
 def send_ip(ip:str, list_name:str=''
 , comment:str='', timeout:str=''):
 	'''	Send IP to device and return
 		status and device answer
 	'''
 	if is_ros():
-		cmd = [
-				'/ip/firewall/address-list/add'
-				, '=list=' + list_name
-				, '=address=' + ip
-		]
-		if timeout: cmd.append('=timeout=' + timeout)
-		if comment: cmd.append('=comment=' + comment)
-		result = rosapi_send(
-			**sett.rosapi_args
-			, cmd = cmd
-		)
-		if result[0]:
-			status, data = ros_answer(result[1])
-			log.debug(ip.ljust(15)
-				, f'rosapi: {status}, {data}')
+		cmd = ros_cmd(ip, list_name, comment, timeout)
+		if sett.rosapi_batcher:
+			result = sett.rosapi_batcher.send(cmd)
+		else:
+			result = sett.rosapi_pool.send(cmd)
 	else:
 		cmd = sett.device['cmd'].format(
 			ip=ip, list_name=list_name
@@ -189,57 +264,335 @@ def send_ip(ip:str, list_name:str=''
 		result = netmiko_send(cmd)
 	return result
 
+class Outbox:
+	''' Queue of IP addresses for the device.
+		A worker takes them from the queue and sends
+		them to the device (via batcher in case of
+		MikroTik) so the request handler does not have
+		to wait for the device.
+		Result of the future is the same as for *send_ip*.
+		Pushes, drops, the queue depth and the slowest push
+		are logged every REPORT_INTERVAL seconds, pushes
+		slower than SLOW_PUSH seconds are logged at once.
+	'''
+	REPORT_INTERVAL = 60
+	SLOW_PUSH = 1.0
+
+	def __init__(self, size:int=1000):
+		self.queue = queue.Queue(maxsize=size)
+		self.dropped = 0
+		self.pushed = 0
+		self.peak = 0
+		self.slowest = 0
+		self.warned = False
+		self.reported = (time.monotonic(), 0, 0)
+		threading.Thread(target=self._worker, daemon=True).start()
+
+	def put(self, ip:str, list_name:str=''
+	, comment:str='', timeout:str='')->Future:
+		''' Queue IP. Return future or None
+			if the queue is full.
+		'''
+		fut = Future()
+		try:
+			self.queue.put_nowait(
+				(fut, time.perf_counter()
+				, (ip, list_name, comment, timeout))
+			)
+		except queue.Full:
+			self.dropped += 1
+			log.error(ip.ljust(15), f'outbox is full, {list_name}'
+				+ f' dropped (total: {self.dropped})')
+			return None
+		depth = self.queue.qsize()
+		if depth > self.peak: self.peak = depth
+		if depth * 2 >= self.queue.maxsize and not self.warned:
+			self.warned = True
+			log.info(f'outbox is half full: {depth}'
+				+ f' of {self.queue.maxsize}')
+		return fut
+
+	def _report(self):
+		' Log the statistics once in REPORT_INTERVAL '
+		now = time.monotonic()
+		last, pushed, dropped = self.reported
+		if now - last < self.REPORT_INTERVAL: return
+		self.reported = (now, self.pushed, self.dropped)
+		if self.pushed == pushed and self.dropped == dropped \
+		and not self.peak:
+			return
+		log.info(f'outbox: pushed {self.pushed - pushed}'
+			+ f', dropped {self.dropped - dropped}'
+			+ f', depth {self.queue.qsize()} (max {self.peak})'
+			+ f', slowest push {self.slowest} ms')
+		self.peak = 0
+		self.slowest = 0
+		self.warned = False
+
+	def _worker(self):
+		while True:
+			try:
+				fut, start, args = self.queue.get(
+					timeout=self.REPORT_INTERVAL)
+			except queue.Empty:
+				self._report()
+				continue
+			self._report()
+			try:
+				if is_ros() and sett.rosapi_batcher:
+					sett.rosapi_batcher.submit(
+						ros_cmd(*args)
+					).add_done_callback(
+						lambda f, fut=fut, start=start, args=args:
+							self._done(fut, start, args, f.result())
+					)
+				else:
+					self._done(fut, start, args, send_ip(*args))
+			except Exception as e:
+				self._done(fut, start, args, (False, repr(e)))
+
+	def _done(self, fut:Future, start:float, args:tuple
+	, result:tuple):
+		self.pushed += 1
+		ip, list_name = args[:2]
+		msec = int((time.perf_counter() - start) * 1000)
+		m_push.observe(time.perf_counter() - start)
+		status, data = push_result(result)
+		if msec > self.slowest: self.slowest = msec
+		if status:
+			if msec >= self.SLOW_PUSH * 1000:
+				log.info(ip.ljust(15), f'slow push to {list_name}'
+					+ f': {msec} ms, queue: {self.queue.qsize()}')
+			log.debug(ip.ljust(15), f'{list_name}: {status}, {data}'
+				+ f' ({msec} ms, queue: {self.queue.qsize()})')
+		else:
+			m_push_errors.inc()
+			log.error(ip.ljust(15), f'error on adding to {list_name}'
+				+ f': {data} ({msec} ms)')
+		fut.set_result(result)
+
+def push_ip(ip:str, list_name:str=''
+, comment:str='', timeout:str='')->Future:
+	''' Queue IP for the device and return at once.
+		Return future or None if the outbox is full.
+	'''
+	return outbox.put(ip, list_name, comment, timeout)
+
+def wait_push(fut:Future)->bool:
+	''' Wait for the push for no longer than
+		'grant_wait' milliseconds.
+		Return device status or None on timeout.
+	'''
+	if not fut: return False
+	try:
+		return push_result(fut.result(
+			timeout=sett.general['grant_wait'] / 1000
+		))[0]
+	except FutureTimeout:
+		return None
+
+def grant_ip(cfg:Settings, user_name:str, ip:str
+, comment:str, timeout:str)->bool:
+	''' Add IP of the user to the white list unless
+		the device already has it for longer than
+		'grant_refresh'.
+		Return the same as *wait_push*.
+	'''
+	left = cfg.grants.left(user_name, ip)
+	if left > ros_timeout(cfg.general['grant_refresh']):
+		log.debug(ip.ljust(15), f'already granted to {user_name}'
+			+ f' for {left:.0f} s')
+		return True
+	fut = push_ip(ip, cfg.general['white_list']
+		, comment=comment, timeout=timeout)
+	if fut:
+		expires = expires_at(timeout)
+		fut.add_done_callback(
+			lambda f: push_result(f.result())[0]
+				and cfg.grants.put(user_name, ip, expires)
+		)
+	return wait_push(fut)
+
+def push_result(result:tuple)->tuple:
+	''' (True, device id or answer) if the device has
+		the address after the push, (False, error text)
+		otherwise. An address that is already in the
+		list counts as pushed.
+	'''
+	status, data = result
+	if status and is_ros():
+		status, data = ros_answer(data)
+		if not status and 'already have' in data:
+			return True, None
+	return status, data
+
+def black_pushed(cfg:Settings, ip:str, result:tuple):
+	''' Remember the device id of the blacklisted IP
+		or remove the entry at once if its network is
+		already in the black list.
+		If the push failed, the record is not black
+		any more.
+	'''
+	status, ros_id = push_result(result)
+	if not status:
+		push_failed(cfg, ip)
+	elif is_ros() and cfg.black_nets.found(ip, ros_id):
+		retire_ips([ros_id])
+
+def push_failed(cfg:Settings, ip:str):
+	''' The device did not get the IP: make the black
+		record grey so the next ban pushes it again.
+	'''
+	def revert(rec):
+		if rec.status != 'black': return
+		cfg.ips.set_status(rec, 'grey')
+		rec.reason = 'push failed'
+
+	cfg.ips.update(ip, revert)
+	log.info(ip.ljust(15), 'not added to the black list')
+
+def aggregate_ip(cfg:Settings, ip:str)->bool:
+	''' Count the blacklisted IP in its network and
+		blacklist the whole network when there are more
+		than 'black_net_threshold' such addresses.
+		Networks with safe hosts or granted IP are
+		never blacklisted.
+		Return True if the network was blacklisted.
+	'''
+	network = cfg.black_nets.add(ip)
+	if not network: return False
+	if cfg.safe_hosts.overlaps(network):
+		log.debug(ip.ljust(15), f'network {network} has safe hosts')
+		return False
+	net = PrefixSet([network])
+	for (user, gip), _ in cfg.grants.items():
+		if gip in net:
+			log.debug(ip.ljust(15), f'network {network}'
+				+ f' has granted IP of {user}')
+			return False
+	timeout = cfg.general['black_timeout']
+	cfg.black_nets.set_black(network, expires_at(timeout))
+	log.info(ip.ljust(15), f'add network to black list: {network}')
+	fut = push_ip(network, cfg.general['black_list']
+		, comment='web_knocking_network', timeout=timeout)
+	if not fut:
+		cfg.black_nets.discard(network)
+		return False
+	fut.add_done_callback(
+		lambda f: net_pushed(cfg, network, ip, f.result()))
+	return True
+
+def net_pushed(cfg:Settings, network:str, ip:str, result:tuple):
+	''' Remove entries of the addresses of the network
+		from the device when the network is there.
+		ip - the address that was banned with the network.
+	'''
+	status, data = push_result(result)
+	if not status:
+		cfg.black_nets.discard(network)
+		push_failed(cfg, ip)
+		return
+	ids = cfg.black_nets.retire(network)
+	if ids and is_ros(): retire_ips(ids)
+
+def retire_ips(ids:list):
+	''' Remove address list entries from the device
+		by their ids without waiting for the answer.
+	'''
+	cmd = ['/ip/firewall/address-list/remove', '=.id=' + ','.join(ids)]
+
+	def done(result:tuple):
+		status, data = result
+		if status: status, data = ros_answer(data)
+		if status:
+			log.debug(f'{len(ids)} entries removed from the device')
+		else:
+			log.error(f'error on removing {len(ids)} entries: {data}')
+
+	if sett.rosapi_batcher:
+		sett.rosapi_batcher.submit(cmd).add_done_callback(
+			lambda f: done(f.result()))
+	else:
+		threading.Thread(target=lambda: done(sett.rosapi_pool.send(cmd))
+			, daemon=True).start()
+
+def is_black(ip:str)->bool:
+	' Is IP or its network in the black list? '
+	return sett.ips.is_black(ip) or sett.black_nets.is_black(ip)
+
+def rate_limited(ip:str)->bool:
+	''' Is the client over the request rate limit
+		of its IP or network? Safe hosts never are.
+	'''
+	cfg = sett
+	if ip in cfg.safe_hosts: return False
+	limit = cfg.limiter.take(ip)
+	if not limit: return False
+	m_rejected.inc('rate_' + limit)
+	log.debug(ip.ljust(15), f'rejected: {limit} rate limit')
+	return True
+
+def conn_limited(ip:str)->bool:
+	''' Count the new connection. Return True if there
+		are too many connections in total or from this IP,
+		such connection is not counted. Too many connections
+		from one IP is bad behavior.
+	'''
+	cfg = sett
+	limit = connections.open(ip, cfg.general['max_connections']
+		, 0 if ip in cfg.safe_hosts
+			else cfg.general['max_ip_connections'])
+	if not limit: return False
+	m_rejected.inc(limit)
+	log.debug(ip.ljust(15), f'rejected: too many {limit}')
+	if limit == 'ip_connections':
+		process_ip(ip, behavior='bad', reason='too many connections')
+	return True
+
 def is_ros()->bool:
 	'Is it a MikroTik device?'
 	return sett.device['device_type'] == \
 		DEF_DEVICE_TYPE
 
 def process_ip(ip:str, behavior:str
-, reason:str='', user:str=None)->tuple:
+, reason:str='', user:str=None, timeout:str='')->tuple:
 	''' Add or not IP to black list on router.
 		Return (True, None) on success or
 		(False, 'error text') on Exception.
 		Three types of behavior:
-			'bad' - increment counter of attempts
-				and ban when the 'black_threshold'
-				is exceeded.
+			'bad' - count the attempt and ban when
+				there are 'black_threshold' of them
+				within 'black_window'.
 			'good' - reset counter
 			'danger' or some string with particular
 			
 			reason - if none then ban immediately without
 				checking 'black_threshold'
+		timeout - how long the device keeps a 'good' IP
+		in the white list.
 	'''
 	if not reason: reason = behavior
-	if ip in sett.ips and user: sett.ips[ip]['user'] = user
 	if behavior != 'good' \
-	and ip in sett.general['safe_hosts']:
+	and ip in sett.safe_hosts:
 		log.debug(ip.ljust(15), 'do not ban safe host'
 			+ f' ({behavior}: {reason})')
 		return True, None
-	if behavior != 'good' \
-	and ip in sett.ips:
-		if sett.ips[ip]['status'] == 'good':
-			log.debug(ip.ljust(15), 'do not ban white ip'
-				+ f' ({behavior}: {reason})')
-			return True, None
-	if ip in sett.ips:
-		if sett.ips[ip]['status'] == 'white' \
+
+	def change(rec)->tuple:
+		' Runs under the lock of the record '
+		nonlocal behavior, reason
+		if user: rec.user = user
+		if behavior != 'good' \
+		and rec.status == 'good':
+			return 'do not ban white ip', False
+		note = None
+		if rec.status == 'white' \
 		and behavior == 'danger':
-			log.debug(ip.ljust(15)
-				, f'white ip: {behavior}: {reason}')
+			note = f'white ip: {behavior}: {reason}'
 			behavior = 'bad'
-	else:
-		sett.ips[ip] = {
-			'ip': ip
-			, 'counter' : 0
-			, 'status' : 'grey'
-			, 'reason' : 'new'
-			, 'user': user
-		}
-	try:
 		if behavior == 'bad':
-			cnt = sett.ips[ip]['counter'] + 1
-			sett.ips[ip]['counter'] = cnt
+			cnt = rec.bad_event(sett.general['black_threshold']
+				, sett.black_window)
 			if cnt >= sett.general['black_threshold']:
 				behavior = 'danger'
 				reason = 'threshold exceed'
@@ -251,29 +604,55 @@ def process_ip(ip:str, behavior:str
 						, sett.general['black_threshold']
 					)
 				)
-		sett.ips[ip]['reason'] = reason
+		if behavior == 'danger' and rec.status == 'black':
+			return 'already in black list', False
+		rec.reason = reason
 		if behavior == 'good':
-			sett.ips[ip]['counter'] = 0
-			sett.ips[ip]['status'] = 'white'
-		elif behavior == 'bad':
+			rec.reset()
+			sett.ips.set_status(rec, 'white'
+				, expires_at(timeout))
+		elif behavior == 'danger':
+			sett.ips.set_status(rec, 'black'
+				, expires_at(sett.general['black_timeout']))
+		return note, True
+
+	try:
+		note, changed = sett.ips.update(ip, change, user)
+		if note:
+			log.debug(ip.ljust(15), note
+				+ ('' if changed else f' ({behavior}: {reason})'))
+		if not changed:
+			return True, None
+		if behavior == 'bad':
 			log.info(ip.ljust(15), f'bad behavior: {reason}')
 		elif behavior == 'danger':
-			sett.ips[ip]['status'] = 'black'
 			log.info(ip.ljust(15), f'add to black list: {reason}')
-			status, data = send_ip(
+			cfg = sett
+			if aggregate_ip(cfg, ip): return True, reason
+			fut = push_ip(
 				ip
-				, list_name = sett.general['black_list']
+				, list_name = cfg.general['black_list']
 				 , comment = ('web_knocking_'
 				 	+ reason.replace(' ', '_')
 				 )
+				, timeout = cfg.general['black_timeout']
 			)
-			if not status:
-				log.error(ip.ljust(15), 'Error on adding to'
-					+ f' blacklist: {data}')
+			if fut:
+				fut.add_done_callback(
+					lambda f: black_pushed(cfg, ip, f.result()))
+			else:
+				push_failed(cfg, ip)
 		return True, reason
 	except Exception as e:
 		return False, repr(e)
 
+def expires_at(timeout:str)->float:
+	''' time.time() when the device removes an address
+		added with this timeout or None if never.
+	'''
+	if not timeout: return None
+	return time.time() + ros_timeout(timeout)
+
 def ros_answer(ros_data:list)->tuple:
 	''' Convert RouterOS API answer
 		to (True, data) on success or 
@@ -289,13 +668,23 @@ def ros_answer(ros_data:list)->tuple:
 	except Exception as e:
 		return False, f'answer error: {e}'
 
-def decision(path:str, ip:str)->list:
+def user_access(user:dict, ip:str=None):
+	''' Remember the time of access and IP of the user '''
+	with user_locks(user['name']):
+		if ip:
+			if ip in user['ips']: user['ips'].remove(ip)
+			user['ips'].append(ip)
+		user['last_access'] = dt.now()
+
+def decision(path:str, ip:str, cfg:Settings=None)->list:
 	''' Look at path and do corresponding action.
 		Returns (True, 'message to show on page')
 		on success or (False, 'error text') on
 		exception.
+		cfg - settings to use, current ones by default.
 	'''
-	global sett
+	cfg = cfg or sett
+	lang = cfg.lang
 	try:
 		message = ''
 		if path == '/':
@@ -303,46 +692,36 @@ def decision(path:str, ip:str)->list:
 			message = lang.ban
 		elif path.startswith('/access'):
 			passcode = path.split(PASS_SEP)[1]
-			user_name = None
-			last_day = None
-			for u in sett.users:
-				if sett.users[u]['passcode'] == passcode:
-					user_name = u
-					last_day = sett.users[u]['last_day']
-					break
+			user_name = cfg.passcodes.get(passcode)
 			if user_name:
+				last_day = cfg.users[user_name]['last_day']
 				if last_day:
-					last_day = dt.strptime(
-						last_day, '%Y-%m-%d'
-					)
-					last_day = last_day \
-						+ timedelta(days=1)
 					if dt.now() \
-					< last_day:
+					< cfg.users[user_name]['expires']:
 						process_ip(ip, behavior='good'
 							, reason='valid date access'
-							, user=user_name)
-						sett.users[user_name]['ips'].append(ip)
-						sett.users[user_name]['last_access'] = \
-							dt.now()
+							, user=user_name
+							, timeout=cfg.general['temp_timeout'])
+						user_access(cfg.users[user_name], ip)
 						log.info(ip.ljust(15)
 							, f'valid date access: {user_name}')
-						status, data = send_ip(
-							ip
-							, sett.general['white_list']
+						status = grant_ip(
+							cfg, user_name, ip
 							, comment='web_knocking_date_'
 								+ passcode
-							, timeout=sett.general['temp_timeout']
+							, timeout=cfg.general['temp_timeout']
 						)
 						if status:
 							message = lang.temp_timeout_text \
 								.format(user_name)
+						elif status is None:
+							message = lang.access_pending \
+								.format(user_name)
 						else:
 							message = lang.access_error \
 								.format(user_name)
 					else:
-						sett.users[user_name]['last_access'] = \
-							dt.now()
+						user_access(cfg.users[user_name])
 						log.info(ip.ljust(15)
 							, f'date expired: {user_name}')
 						process_ip(ip, behavior='bad', reason='date expired'
@@ -354,43 +733,41 @@ def decision(path:str, ip:str)->list:
 					log.info(ip.ljust(15)
 						, f'permanent access: {user_name}')
 					process_ip(ip, behavior='good', reason='permanent access'
-						, user=user_name)
-					sett.users[user_name]['ips'].append(ip)
-					sett.users[user_name]['last_access'] = \
-						dt.now()
-					status, data = send_ip(
-						ip
-						, sett.general['white_list']
+						, user=user_name
+						, timeout=cfg.general['perm_timeout'])
+					user_access(cfg.users[user_name], ip)
+					status = grant_ip(
+						cfg, user_name, ip
 						, comment='web_knocking_permanent_'
 							+ passcode
-						, timeout=sett.general['perm_timeout']
+						, timeout=cfg.general['perm_timeout']
 					)
 					if status:
 						message = lang.perm_timeout_text \
 							.format(user_name)
-
+					elif status is None:
+						message = lang.access_pending \
+							.format(user_name)
 					else:
-						log.debug(ip.ljust(15)
-							, f'send_ip error: {data}')
 						message = lang.access_error \
 							.format(user_name)
 			else:
 				message = lang.pass_unknown
 				process_ip(ip, behavior='bad', reason='unknown user')
 		elif path == '/status':
-			if ip in sett.general['safe_hosts']:
+			if ip in cfg.safe_hosts:
 				try:
 					dates = [
 						d['last_access']
-							for d in sett.users.values()
+							for d in cfg.users.values()
 								if d['last_access']
 					]
 					if dates:
 						last_acc = max(dates)
-						for u in sett.users:
-							if sett.users[u]['last_access'] == last_acc:
+						for u in cfg.users:
+							if cfg.users[u]['last_access'] == last_acc:
 								last_user = u
-								last_ip = sett.users[u]['ips'][-1]
+								last_ip = cfg.users[u]['ips'][-1]
 								break
 						message = '{}\t{}\t{}'.format(
 							last_user
@@ -408,12 +785,17 @@ def decision(path:str, ip:str)->list:
 			else:
 				process_ip(ip, behavior='danger', reason='status unsafe')
 				message = lang.ban
+		elif path == '/metrics':
+			if ip in cfg.safe_hosts:
+				message = metrics.render()
+			else:
+				process_ip(ip, behavior='danger', reason='metrics unsafe')
+				message = lang.ban
 		elif path == '/reload':
-			if ip in sett.general['safe_hosts']:
-				status, data = load_settings()
+			if ip in cfg.safe_hosts:
+				status, data = reload_settings()
 				if status:
 					log.info(ip.ljust(15), 'settings reloaded')
-					sett = data
 					print_users()
 					message = 'reloaded'
 				else:
@@ -431,12 +813,188 @@ def decision(path:str, ip:str)->list:
 		log.debug(f'line: {e.__traceback__.tb_lineno}')
 		return False, repr(e)
 
+def sync_lists()->tuple:
+	''' Load white and black lists from the device
+		into the IP table. Addresses that were removed
+		on the device become grey and lose their grants,
+		removed networks are not blacklisted any more.
+		Return (True, {'list': count}) on success or
+		(False, 'error text').
+	'''
+	cfg = sett
+	counts = {}
+	try:
+		for list_name, status in (
+			(cfg.general['white_list'], 'white')
+			, (cfg.general['black_list'], 'black')
+		):
+			started = time.time()
+			seen = set()
+			networks = []
+			retire = []
+			for entry in address_list(cfg.rosapi_pool, list_name
+			, '.id,address,timeout,comment,disabled'):
+				ip = entry.get('=address', '')
+				if entry.get('=disabled') == 'true': continue
+				timeout = entry.get('=timeout')
+				try:
+					expires = started + ros_timeout(timeout) \
+						if timeout else None
+				except ValueError:
+					log.debug(cfg.device['host'].ljust(15)
+						, f'{list_name}: skip {ip}, wrong timeout: {timeout}')
+					continue
+				if '/' in ip:
+					if status == 'black' \
+					and cfg.black_nets.set_black(ip, expires, True):
+						networks.append(ip)
+					continue
+				try:
+					seen.add(ip_key(ip))
+				except OSError:
+					continue
+				if status == 'black' \
+				and cfg.black_nets.found(ip, entry.get('=.id')):
+					retire.append(entry['=.id'])
+				passcode = entry.get('=comment', '').rsplit(PASS_SEP, 1)[-1]
+				user = cfg.passcodes.get(passcode) \
+					if status == 'white' else None
+
+				def load(rec, status=status, expires=expires, user=user):
+					if rec.status != status:
+						rec.reason = 'device'
+					if user:
+						rec.user = user
+						cfg.grants.put(user, rec.ip, expires)
+					cfg.ips.set_status(rec, status, expires)
+
+				cfg.ips.update(ip, load)
+			if status == 'white':
+				for (user, gip), _ in cfg.grants.items():
+					if ip_key(gip) in seen: continue
+					rec = cfg.ips.get(gip)
+					if rec and rec.touched >= started: continue
+					cfg.grants.remove(user, gip)
+			else:
+				cfg.black_nets.reconcile(networks, started)
+			for rec in cfg.ips.values():
+				if rec.status == status and rec.key not in seen \
+				and rec.since < started:
+					cfg.ips.set_status(rec, 'grey')
+					rec.reason = 'removed on device'
+			counts[list_name] = len(seen)
+			if retire: retire_ips(retire)
+		return True, counts
+	except Exception as e:
+		return False, repr(e)
+
+def sync_worker():
+	''' Synchronize lists with the device every
+		'sync_interval' or when *sync_now* is set.
+	'''
+	while True:
+		if not is_ros(): return
+		start = time.perf_counter()
+		status, data = sync_lists()
+		if status:
+			log.debug(sett.device['host'].ljust(15)
+				, f'lists synchronized: {data}'
+				+ f' ({time.perf_counter() - start:.1f} s)')
+		else:
+			log.error(sett.device['host'].ljust(15)
+				, f'lists sync error: {data}')
+		interval = ros_timeout(sett.general['sync_interval'])
+		sync_now.wait(interval or None)
+		sync_now.clear()
+
+def save_snapshot()->tuple:
+	''' Save the IP table, grants and activity of users
+		to the 'snapshot' file via temporary file.
+		Return (True, number of IP) on success or
+		(False, 'error text').
+	'''
+	cfg = sett
+	fname = cfg.general['snapshot']
+	try:
+		users = {}
+		for name, user in cfg.users.items():
+			with user_locks(name):
+				if not user['last_access']: continue
+				users[name] = (
+					user['last_access'].timestamp()
+					, user['ips'][:]
+				)
+		data = {
+			'version' : 1
+			, 'ips' : cfg.ips.dump()
+			, 'grants' : cfg.grants.items()
+			, 'users' : users
+		}
+		tmp = fname + '.tmp'
+		with open(tmp, 'wb') as fd:
+			pickle.dump(data, fd, protocol=pickle.HIGHEST_PROTOCOL)
+			fd.flush()
+			os.fsync(fd.fileno())
+		os.replace(tmp, fname)
+		return True, len(data['ips'])
+	except Exception as e:
+		return False, repr(e)
+
+def load_snapshot()->tuple:
+	''' Load state saved by *save_snapshot*.
+		Return (True, number of IP) on success or
+		(False, 'error text').
+	'''
+	cfg = sett
+	fname = cfg.general['snapshot']
+	if not os.path.exists(fname): return True, 0
+	try:
+		with open(fname, 'rb') as fd:
+			data = pickle.load(fd)
+		num = cfg.ips.restore(data['ips'])
+		cfg.grants.restore(data['grants'])
+		for name, (last_access, ips) in data['users'].items():
+			user = cfg.users.get(name)
+			if not user: continue
+			with user_locks(name):
+				user['last_access'] = dt.fromtimestamp(last_access)
+				user['ips'][:0] = [i for i in ips if not i in user['ips']]
+		return True, num
+	except Exception as e:
+		return False, repr(e)
+
+def snapshot_worker():
+	''' Save snapshot every 'snapshot_interval' '''
+	while True:
+		interval = ros_timeout(sett.general['snapshot_interval'])
+		if not interval: return
+		time.sleep(interval)
+		status, data = save_snapshot()
+		if not status:
+			log.error(f'snapshot saving error: {data}')
+
+def on_exit():
+	if not sett.general['snapshot']: return
+	status, data = save_snapshot()
+	if status:
+		log.info(f'snapshot saved: {data} IP')
+	else:
+		log.error(f'snapshot saving error: {data}')
+
+def on_signal(signum, frame):
+	''' SIGTERM or SIGBREAK: leave the server loop
+		the normal way so *on_exit* runs.
+	'''
+	log.info(f'Terminated by signal {signum}')
+	raise SystemExit(0)
+
 def print_users():
 	'Print the dict of users as a table'
 	table = [ ['User', 'Last Day', 'Last IP', 'Last Access'] ]
 	for user in sett.users.values():
 		if last_day := user.get('last_day'):
-			if dt.strptime(last_day, '%Y-%m-%d') < dt.now():
+			last_day = last_day.strftime('%Y-%m-%d')
+			if user['expires'] < dt.now():
 				last_day = '*' + last_day
 		table.append([
 			user['name']
@@ -449,25 +1007,134 @@ def print_users():
 
 def print_ips():
 	table = [ ['User', 'IP', 'Status', 'Reason'] ]
-	for ip in sett.ips.values():
+	for rec in sett.ips.values():
 		table.append([
-			ip['user']
-			, ip['ip']
-			, ip['status']
-			, ip['reason']
+			rec.user
+			, rec.ip
+			, rec.status
+			, rec.reason
 		])
 	table_print(table, use_headers=True, sorting=[0, 1])
 
+def reset_connection(sock:socket.socket):
+	''' Close the socket with RST instead of FIN '''
+	try:
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER
+			, struct.pack('ii', 1, 0))
+	except OSError:
+		pass
+
+class KnockServer(ThreadingHTTPServer):
+	''' Drops connections from blacklisted addresses
+		and connections over 'max_connections' and
+		'max_ip_connections' right after accept, before
+		a thread for the request is started.
+		A watchdog shuts down connections that did not
+		send the request headers in 'header_timeout'
+		seconds.
+	'''
+	request_queue_size = 128
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.peers = {}
+		self.deadlines = {}
+		self.lock = threading.Lock()
+		threading.Thread(target=self._watchdog, daemon=True).start()
+
+	def verify_request(self, request, client_address)->bool:
+		ip = client_address[0]
+		if is_black(ip):
+			m_rejected.inc('black')
+			log.debug(ip.ljust(15), 'rejected: in black list')
+			reset_connection(request)
+			request.close()
+			return False
+		if conn_limited(ip):
+			reset_connection(request)
+			request.close()
+			return False
+		timeout = sett.general['header_timeout']
+		with self.lock:
+			self.peers[request] = ip
+			if timeout:
+				self.deadlines[request] = time.monotonic() + timeout
+		return True
+
+	def headers_read(self, request)->bool:
+		''' The handler has read the headers. Return False
+			if the connection was shut down by the watchdog.
+		'''
+		with self.lock:
+			if self.cut_off(request): return False
+			self.deadlines.pop(request, None)
+			return True
+
+	def cut_off(self, request)->bool:
+		' Was the connection shut down by the watchdog? '
+		return request in self.deadlines \
+			and self.deadlines[request] is None
+
+	def shutdown_request(self, request):
+		with self.lock:
+			ip = self.peers.pop(request, None)
+			self.deadlines.pop(request, None)
+		if ip: connections.close(ip)
+		super().shutdown_request(request)
+
+	def _watchdog(self):
+		while True:
+			time.sleep(1)
+			now = time.monotonic()
+			with self.lock:
+				expired = [r for r, d in self.deadlines.items()
+					if d and d < now]
+				for r in expired: self.deadlines[r] = None
+				expired = [(r, self.peers[r]) for r in expired]
+			for request, ip in expired:
+				m_rejected.inc('header_timeout')
+				log.debug(ip.ljust(15), 'header timeout')
+				try:
+					request.shutdown(socket.SHUT_RDWR)
+				except OSError:
+					pass
+				process_ip(ip, behavior='bad', reason='header timeout')
+
 class KnockHandler(BaseHTTPRequestHandler):
+	''' Every read is limited by 'read_timeout' seconds,
+		a request that timed out after the request line
+		is bad behavior.
+	'''
+	def setup(self):
+		self.timeout = sett.general['read_timeout'] or None
+		self.timed_out = False
+		self.raw_requestline = b''
+		super().setup()
+
+	def parse_request(self)->bool:
+		status = super().parse_request()
+		return self.server.headers_read(self.request) and status
+
+	def log_error(self, msg_format, *args):
+		if msg_format.startswith('Request timed out'):
+			self.timed_out = True
+		super().log_error(msg_format, *args)
+
 	def handle_one_request(self):
 		try:
 			super().handle_one_request()
+			if self.timed_out:
+				if self.raw_requestline:
+					process_ip(self.address_string(), behavior='bad'
+						, reason='read timeout')
+				return
 			req_type = str(self.raw_requestline
 				, encoding='iso-8859-1').split()[0].upper()
 			if req_type != 'GET':
 				process_ip(self.address_string()
 					, behavior='danger', reason='wrong request method')
 		except ConnectionResetError:
+			if self.server.cut_off(self.request): return
 			log.debug(self.address_string().ljust(15)
 				, 'connection reset')
 			process_ip(self.address_string(), behavior='bad'
@@ -497,67 +1164,325 @@ class KnockHandler(BaseHTTPRequestHandler):
 	def send_error(self, code, message=None
 	, explain=None):
 		if code > 500:
-			self.send_response(200)
-			self.send_header('Content-type','text/html; charset=utf-8')
-			self.end_headers()
-			self.wfile.write(bytes(lang.ban, 'utf-8'))
+			self.send_body(sett.ban)
 		else:
 			super().send_error(code, message, explain) 
 
+	def send_body(self, body:bytes
+	, ctype:str='text/html; charset=utf-8'):
+		self.send_response(200)
+		self.send_header('Content-type', ctype)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
 			
 	def do_GET(self):
+		if rate_limited(self.address_string()):
+			self.close_connection = True
+			self.wfile.write(TOO_MANY_REQUESTS)
+			return
 		if 'favicon.' in self.path:
-			self.wfile.write(sett.favicon)
+			m_requests.inc('favicon')
+			self.send_body(sett.favicon, 'image/png')
 			return
-		self.send_response(200)
-		self.send_header('Content-type','text/html; charset=utf-8')
-		self.end_headers()
-		status, data = decision(self.path, self.address_string() )
-		if status:
-			message = data
-		else:
-			log.debug(
-				self.address_string().ljust(15)
-				, 'decision error: ' + data
-			)
-			message = lang.ban
-		if self.path == '/status':
-			page = message
-		else:
-			page = sett.html.format(
-				message=message
-				, timestamp = dt.now() \
-					.strftime('%Y.%m.%d %H:%M:%S')
-				, ip_address = self.address_string()
-				, ip_capt = lang.ip_capt
-				, time_capt = lang.time_capt
-				, page_title = lang.page_title
-			).replace('\n', '').replace('\t', '')
-		self.wfile.write(bytes(page, 'utf-8'))
+		self.send_body(
+			answer(self.path, self.address_string())
+			, RAW_PATHS.get(self.path, 'text/html; charset=utf-8')
+		)
 
 	def log_message(self, msg_format, *args):
-		global event_counter
-		if args[0].startswith('GET /status') \
-		or args[0].startswith('GET /reload') \
-		and not sett.general['developer']:
+		log_http(self.address_string(), ' '.join(map(str, args)))
+
+def path_class(path:str)->str:
+	' Kind of the path for metrics '
+	if path in ('/', '/status', '/reload', '/metrics'):
+		return path
+	elif path.startswith('/access'):
+		return '/access'
+	return 'other'
+
+def answer(path:str, ip:str)->bytes:
+	''' Make a decision and render the page.
+		The whole request uses the same settings
+		even if they are reloaded meanwhile.
+	'''
+	cfg = sett
+	m_requests.inc(path_class(path))
+	with m_decision.time():
+		status, data = decision(path, ip, cfg)
+	if status:
+		message = data
+	else:
+		log.debug(ip.ljust(15), 'decision error: ' + data)
+		message = cfg.lang.ban
+	return render_page(path, ip, message, cfg)
+
+def compile_page(html:str, lng:resources.Language)->list:
+	''' Minify the template and split it into encoded
+		static chunks and names of the dynamic fields
+		(see PAGE_FIELDS). Other fields are filled in
+		from the language.
+	'''
+	parts = []
+	chunk = ''
+	html = html.replace('\n', '').replace('\t', '')
+	for literal, field, spec, _ in string.Formatter().parse(html):
+		chunk += literal
+		if field is None: continue
+		if field in PAGE_FIELDS:
+			parts.extend((chunk.encode('utf-8'), field))
+			chunk = ''
+		else:
+			chunk += format(getattr(lng, field), spec)
+	parts.append(chunk.encode('utf-8'))
+	return parts
+
+_page_time = (0, b'')
+
+def page_timestamp()->bytes:
+	''' Encoded timestamp, changes once a second '''
+	global _page_time
+	sec = int(time.time())
+	if sec != _page_time[0]:
+		_page_time = (sec, dt.fromtimestamp(sec)
+			.strftime('%Y.%m.%d %H:%M:%S').encode('utf-8'))
+	return _page_time[1]
+
+def render_page(path:str, ip:str, message:str
+, cfg:Settings=None)->bytes:
+	''' Page for the message '''
+	cfg = cfg or sett
+	if path in RAW_PATHS:
+		return bytes(message, 'utf-8')
+	values = {
+		'message' : cfg.messages.get(message)
+			or bytes(message, 'utf-8')
+		, 'ip_address' : bytes(ip, 'utf-8')
+		, 'timestamp' : page_timestamp()
+	}
+	return b''.join(
+		values[p] if isinstance(p, str) else p
+			for p in cfg.page
+	)
+
+def log_http(ip:str, text:str):
+	''' Log a request and count it in the console title '''
+	global event_counter
+	if text.startswith('GET /status') \
+	or text.startswith('GET /metrics') \
+	or text.startswith('GET /reload') \
+	and not sett.general['developer']:
+		return
+	event_counter += 1
+	set_title(event_counter)
+	log.http(ip.ljust(15), text)
+
+def http_response(body:bytes, code:str='200 OK'
+, ctype:str='text/html; charset=utf-8')->bytes:
+	''' Whole HTTP/1.0 response with headers '''
+	return (
+		f'HTTP/1.0 {code}\r\n'
+		+ f'Date: {formatdate(usegmt=True)}\r\n'
+		+ f'Content-type: {ctype}\r\n'
+		+ f'Content-Length: {len(body)}\r\n'
+		+ 'Connection: close\r\n\r\n'
+	).encode('iso-8859-1') + body
+
+async def handle_connection(reader:asyncio.StreamReader
+, writer:asyncio.StreamWriter):
+	''' asyncio version of the KnockHandler.
+		Every read is limited by 'read_timeout' seconds
+		and all of the headers by 'header_timeout'.
+	'''
+	ip = writer.get_extra_info('peername')[0]
+	if is_black(ip):
+		m_rejected.inc('black')
+		log.debug(ip.ljust(15), 'rejected: in black list')
+		reset_connection(writer.get_extra_info('socket'))
+		writer.transport.abort()
+		return
+	if conn_limited(ip):
+		reset_connection(writer.get_extra_info('socket'))
+		writer.transport.abort()
+		return
+	loop = asyncio.get_running_loop()
+	timeout = sett.general['read_timeout'] or None
+	deadline = loop.time() \
+		+ (sett.general['header_timeout'] or float('inf'))
+	stage = 'line'
+	header_wait = False
+
+	async def read_line()->bytes:
+		nonlocal header_wait
+		wait = deadline - loop.time()
+		header_wait = not timeout or wait <= timeout
+		if not header_wait: wait = timeout
+		return await asyncio.wait_for(reader.readline()
+			, None if wait == float('inf') else max(wait, 0))
+
+	try:
+		line = await read_line()
+		if not line:
+			log.debug(ip.ljust(15), 'raw_requestline:  (len=0)')
+			return
+		requestline = str(line, encoding='iso-8859-1').rstrip('\r\n')
+		words = requestline.split()
+		if len(words) != 3:
+			log.debug(ip.ljust(15), 'raw_requestline: {} (len={})'
+				.format(requestline, len(requestline)))
+			writer.write(http_response(b'Bad request'
+				, '400 Bad Request', 'text/plain'))
+			log_http(ip, f'{requestline} 400 -')
+			if words and words[0].upper() != 'GET':
+				process_ip(ip, behavior='danger'
+					, reason='wrong request method')
+			return
+		stage = 'headers'
+		while True:
+			header = await read_line()
+			if header in (b'\r\n', b'\n', b''): break
+		stage = 'done'
+		req_type, path = words[0].upper(), words[1]
+		if req_type != 'GET':
+			writer.write(http_response(sett.ban))
+			log_http(ip, f'{requestline} 501 -')
+			process_ip(ip, behavior='danger'
+				, reason='wrong request method')
 			return
-		event_counter += 1
-		set_title(event_counter)
-		log.http(
-			self.address_string().ljust(15)
-			, ' '.join(args)
+		if rate_limited(ip):
+			writer.write(TOO_MANY_REQUESTS)
+			return
+		if 'favicon.' in path:
+			m_requests.inc('favicon')
+			writer.write(http_response(sett.favicon
+				, ctype='image/png'))
+			log_http(ip, f'{requestline} 200 -')
+			return
+		page = await asyncio.get_running_loop() \
+			.run_in_executor(None, answer, path, ip)
+		writer.write(http_response(page
+			, ctype=RAW_PATHS.get(path, 'text/html; charset=utf-8')))
+		log_http(ip, f'{requestline} 200 -')
+		await asyncio.wait_for(writer.drain(), timeout)
+	except asyncio.TimeoutError:
+		if stage == 'done':
+			log.debug(ip.ljust(15), 'write timeout')
+		elif header_wait:
+			m_rejected.inc('header_timeout')
+			log.debug(ip.ljust(15), 'header timeout')
+			process_ip(ip, behavior='bad', reason='header timeout')
+		elif stage == 'headers':
+			log.debug(ip.ljust(15), 'read timeout')
+			process_ip(ip, behavior='bad', reason='read timeout')
+		else:
+			log.debug(ip.ljust(15), 'read timeout')
+	except ConnectionResetError:
+		log.debug(ip.ljust(15), 'connection reset')
+		process_ip(ip, behavior='bad', reason='port scan')
+	except Exception as e:
+		log.debug(ip.ljust(15), 'h_o_r exception: ' + repr(e)
+			+ f'\n\tat line: {e.__traceback__.tb_lineno}')
+		process_ip(ip, behavior='danger', reason='h_o_r exception')
+	finally:
+		connections.close(ip)
+		writer.close()
+
+def serve_async(port:int):
+	''' Serve with asyncio on one thread '''
+	async def serve():
+		server = await asyncio.start_server(
+			handle_connection, '0.0.0.0', port, backlog=1024
 		)
+		async with server:
+			await server.serve_forever()
+	asyncio.run(serve())
+
+def file_stamp(path:str)->tuple:
+	' (mtime, size) of the file or None if there is no file '
+	try:
+		st = os.stat(path)
+		return st.st_mtime_ns, st.st_size
+	except OSError:
+		return None
+
+def file_stamps()->dict:
+	' Stamps of the settings file and files of the page '
+	return {f: file_stamp(f) for f in (INI_FILE, HTML_FILE, FAVICON_FILE)}
+
+def publish_settings(new_sett:Settings):
+	''' Make the settings current. Requests that already
+		took the old ones finish with them.
+		The state shared by old and new settings is
+		reconfigured here and not in *load_settings*
+		so a failed load changes nothing.
+	'''
+	global sett
+	global lang
+	new_sett.ips.size, new_sett.ips.grey_ttl = new_sett.table_args
+	new_sett.limiter.configure(*new_sett.limiter_args)
+	new_sett.black_nets.configure(*new_sett.black_net_args)
+	old_sett = sett
+	sett = new_sett
+	lang = new_sett.lang
+	sync_now.set()
+	if not old_sett: return
+	if old_sett.rosapi_batcher \
+	and old_sett.rosapi_batcher is not new_sett.rosapi_batcher:
+		old_sett.rosapi_batcher.close()
+	if old_sett.rosapi_pool \
+	and old_sett.rosapi_pool is not new_sett.rosapi_pool:
+		old_sett.rosapi_pool.close()
+
+def reload_settings()->tuple:
+	''' Load settings and publish them on success.
+		Returns the result of load_settings().
+	'''
+	with reload_lock:
+		status, data = load_settings()
+		if status: publish_settings(data)
+	return status, data
+
+def settings_watcher():
+	''' Reload settings when the .ini file or files
+		of the page change. Files are checked every
+		'watch_interval' and have to stay the same for
+		two checks in a row so a half-written file
+		is not loaded.
+	'''
+	last = None
+	failed = None
+	while True:
+		interval = ros_timeout(sett.general['watch_interval'])
+		if not interval: return
+		time.sleep(interval)
+		stamps = file_stamps()
+		if stamps == sett.stamps or stamps == failed \
+		or stamps != last:
+			last = stamps
+			continue
+		log.info('settings files changed')
+		status, data = reload_settings()
+		if status:
+			log.info('settings reloaded')
+			print_users()
+		else:
+			failed = stamps
+			log.error('failed to reload settings:', data)
 
 def load_settings()->tuple:
 	''' Load settings from .ini file. '''
-	global sett
 	try:
+		stamps = file_stamps()
 		new_sett = Settings(keep_setting_case=True)
+		new_sett.stamps = stamps
 		for opt in DEF_OPT_GENERAL:
 			new_sett.general.setdefault(*opt)
 		for opt in DEF_OPT_DEVICE:
 			new_sett.device.setdefault(*opt)
-			new_sett.ips = {}
+		new_sett.table_args = (
+			new_sett.general['ip_table_size']
+			, ros_timeout(new_sett.general['grey_timeout'])
+		)
 		if isinstance(new_sett.general['safe_hosts'], str):
 			ip_string = new_sett.general['safe_hosts']
 			new_sett.general['safe_hosts'] = []
@@ -565,30 +1490,97 @@ def load_settings()->tuple:
 				new_sett.general['safe_hosts'].append(
 					ip.strip()
 				)
-		users_di = new_sett.users
+		new_sett.safe_hosts = PrefixSet(new_sett.general['safe_hosts'])
+		new_sett.limiter_args = (
+			float(new_sett.general['rate_limit'])
+			, float(new_sett.general['rate_burst'])
+			, float(new_sett.general['rate_net_limit'])
+			, float(new_sett.general['rate_net_burst'])
+			, new_sett.general['rate_prefix']
+			, new_sett.general['rate_prefix6']
+		)
+		check_prefixes(*new_sett.limiter_args[4:])
+		new_sett.black_window = ros_timeout(
+			new_sett.general['black_window'])
+		new_sett.black_net_args = (
+			new_sett.general['black_net_prefix']
+			, new_sett.general['black_net_prefix6']
+			, new_sett.general['black_net_threshold']
+			, ros_timeout(new_sett.general['black_net_window'])
+		)
+		check_prefixes(*new_sett.black_net_args[:2])
+		# Shared state is reconfigured by *publish_settings*
+		if sett:
+			new_sett.ips = sett.ips
+			new_sett.grants = sett.grants
+			new_sett.limiter = sett.limiter
+			new_sett.black_nets = sett.black_nets
+		else:
+			new_sett.ips = IpTable(*new_sett.table_args)
+			new_sett.grants = GrantCache()
+			new_sett.limiter = RateLimiter(new_sett.table_args[0])
+			new_sett.limiter.configure(*new_sett.limiter_args)
+			new_sett.black_nets = NetAggregator()
+			new_sett.black_nets.configure(*new_sett.black_net_args)
+		new_sett.users_raw = new_sett.users
 		new_sett.users = {}
-		for user in users_di:
-			if ' ' in users_di[user]:
-				passcode, last_day = users_di[user].split()
+		new_sett.passcodes = {}
+		for user, raw in new_sett.users_raw.items():
+			old = sett.users.get(user) if sett else None
+			if old and sett.users_raw.get(user) == raw:
+				new_sett.users[user] = old
+				new_sett.passcodes.setdefault(old['passcode'], user)
+				continue
+			if ' ' in raw:
+				passcode, last_day = raw.split()
+				last_day = dt.strptime(last_day, '%Y-%m-%d')
+				expires = last_day + timedelta(days=1)
 			else:
-				passcode = users_di[user]
+				passcode = raw
 				last_day = None
+				expires = None
 			new_sett.users[user] = {
 				'name' : user
 				, 'passcode' : passcode
 				, 'last_access' : None
 				, 'last_day' : last_day
+				, 'expires' : expires
 				, 'ips' : []
 			}
-		if os.path.exists('files/index.html'):
-			with open('files/index.html'
-			, encoding='utf-8') as fd:
+			if old:
+				with user_locks(user):
+					new_sett.users[user]['last_access'] = \
+						old['last_access']
+					new_sett.users[user]['ips'] = old['ips']
+			new_sett.passcodes.setdefault(passcode, user)
+		if sett and sett.stamps[HTML_FILE] == stamps[HTML_FILE]:
+			new_sett.html = sett.html
+		elif stamps[HTML_FILE]:
+			with open(HTML_FILE, encoding='utf-8') as fd:
 				new_sett.html = fd.read()
 		else:
 			new_sett.html = resources.HTML_DEFAULT
-		if os.path.exists('files/favicon.png'):
-			with open('files/favicon.png'
-			, encoding='rb') as fd:
+		if sett and sett.html is new_sett.html \
+		and sett.general['language'] == new_sett.general['language']:
+			new_sett.lang = sett.lang
+			new_sett.page = sett.page
+			new_sett.ban = sett.ban
+			new_sett.messages = sett.messages
+		else:
+			new_sett.lang = resources.Language(
+				new_sett.general['language'])
+			new_sett.page = compile_page(new_sett.html, new_sett.lang)
+			new_sett.ban = bytes(new_sett.lang.ban, 'utf-8')
+			new_sett.messages = {
+				m : bytes(m, 'utf-8') for m in (
+					new_sett.lang.ban
+					, new_sett.lang.pass_unknown
+				)
+			}
+		if sett and sett.stamps[FAVICON_FILE] == stamps[FAVICON_FILE]:
+			new_sett.favicon = sett.favicon
+		elif stamps[FAVICON_FILE]:
+			with open(FAVICON_FILE, 'rb') as fd:
 				new_sett.favicon = fd.read()
 		else:
 			new_sett.favicon = resources.FAVICON
@@ -599,14 +1591,34 @@ def load_settings()->tuple:
 				, 'username' : new_sett.device['username']
 				, 'password' : new_sett.device['password']
 				, 'secure' : new_sett.device['secure']
+				, 'size' : new_sett.device['pool_size']
+				, 'timeout' : new_sett.device['timeout']
+				, 'check_idle' : new_sett.device['check_idle']
+				, 'print_debug' : new_sett.general['developer']
 			}
-			if sett:
-				new_sett.ips = sett.ips
-				for u in sett.users:
-					if new_sett.users.get(u):
-						new_sett.users[u]['last_access'] = \
-							sett.users[u]['last_access']
-						new_sett.users[u]['ips'] = sett.users[u]['ips']
+			if sett and sett.rosapi_pool \
+			and sett.rosapi_args == new_sett.rosapi_args:
+				new_sett.rosapi_pool = sett.rosapi_pool
+			else:
+				new_sett.rosapi_pool = RosPool(**new_sett.rosapi_args)
+				new_sett.rosapi_pool.timer = m_rosapi.observe
+			batch_args = (
+				new_sett.device['batch_window']
+				, new_sett.device['batch_size']
+			)
+			if not batch_args[0]:
+				new_sett.rosapi_batcher = None
+			elif sett and sett.rosapi_batcher \
+			and sett.rosapi_batcher.pool is new_sett.rosapi_pool \
+			and sett.batch_args == batch_args:
+				new_sett.rosapi_batcher = sett.rosapi_batcher
+			else:
+				new_sett.rosapi_batcher = RosBatcher(
+					new_sett.rosapi_pool
+					, window = batch_args[0] / 1000
+					, size = batch_args[1]
+				)
+			new_sett.batch_args = batch_args
 		return True, new_sett
 	except Exception as e:
 		return False, repr(e)
@@ -693,15 +1705,43 @@ def table_print(table, use_headers=False, row_sep:str=None
 		print(template.format(*row))
 	print()
 
+def ip_counts()->dict:
+	' Number of IP addresses in the table by status '
+	counts = {('black',): 0, ('white',): 0, ('grey',): 0}
+	for rec in sett.ips.values():
+		counts[(rec.status,)] = counts.get((rec.status,), 0) + 1
+	return counts
+
+metrics.gauge('knock_ip_table_size', 'Records in the IP table'
+	, lambda: len(sett.ips))
+metrics.gauge('knock_ips', 'IP addresses by status'
+	, ip_counts, ('status',))
+metrics.gauge('knock_black_networks', 'Networks in the black list'
+	, lambda: len(sett.black_nets))
+metrics.gauge('knock_connections', 'Open connections'
+	, lambda: connections.total)
+metrics.gauge('knock_outbox_depth', 'Addresses waiting for the device'
+	, lambda: outbox.queue.qsize() if outbox else 0)
+metrics.gauge('knock_outbox_dropped_total', 'Addresses dropped'
+	+ ' because the outbox was full'
+	, lambda: outbox.dropped if outbox else 0, kind='counter')
+metrics.gauge('knock_router_errors_total', 'Failed RouterOS API commands'
+	, lambda: sett.rosapi_pool.errors if sett.rosapi_pool else 0
+	, kind='counter')
+metrics.gauge('knock_router_reconnects_total', 'RouterOS API sessions'
+	+ ' that were found broken and opened again'
+	, lambda: sett.rosapi_pool.reconnects if sett.rosapi_pool else 0
+	, kind='counter')
+
 def main():
 	global sett
 	global log
 	global lang
+	global outbox
 	if os.name == 'nt':
 		set_title()
 
 		def key_wait():
-			global sett
 			while True:
 				if msvcrt.kbhit():
 					key = msvcrt.getch()
@@ -712,9 +1752,8 @@ def main():
 						print_ips()
 					elif key in b'sS\xeb\x9b':
 						log.info('reload settings')
-						status, data = load_settings()
+						status, data = reload_settings()
 						if status:
-							sett = data
 							print_users()
 						else:
 							log.error('failed to reload settings:', data)
@@ -725,15 +1764,24 @@ def main():
 	if not status:
 		print('Error loading settings:', sett)
 		exit(1)
+	log_args = {
+		'add_levels' : ('HTTP', 10)
+		, 'background' : True
+		, 'max_size' : sett.general['log_max_size'] * 2**20
+		, 'keep_files' : sett.general['log_keep_files']
+		, 'keep_size' : sett.general['log_keep_size'] * 2**20
+		, 'compress' : True
+	}
 	if sett.general['developer']:
 		log = EasyLogging(
 			level=0, directory='logs'
-			, add_levels=('HTTP', 10)
+			, **log_args
 		)
 	else:
 		d = 'logs' if sett.general['log_file'] else None
-		log = EasyLogging(directory=d, add_levels=('HTTP', 10))
-	lang = resources.Language(sett.general['language'])
+		log = EasyLogging(directory=d, **log_args)
+	lang = sett.lang
+	outbox = Outbox(sett.general['outbox_size'])
 	print('It\'s a wonderful day to ban some robots!')
 	print(f'Version: {APP_VERSION}')
 	print(lang.homepage)
@@ -741,11 +1789,8 @@ def main():
 	if sett.general['developer']:
 		print('\nDEVELOPER MODE')
 	if is_ros():
-		status, data = rosapi_send(
-			**sett.rosapi_args
-			, cmd=[r'/log/info'
-				, "=message=knock-knock"]
-			, print_debug=sett.general['developer']
+		status, data = sett.rosapi_pool.send(
+			[r'/log/info', "=message=knock-knock"]
 		)
 		if status:
 			log.info(sett.device['host'].ljust(15)
@@ -757,16 +1802,37 @@ def main():
 					+ 'Check "/ip services"\n'
 					+ 'Check firewalls\n'
 			)
+	if sett.general['snapshot']:
+		start = time.perf_counter()
+		status, data = load_snapshot()
+		if status:
+			log.info(f'snapshot loaded: {data} IP'
+				+ f' ({time.perf_counter() - start:.2f} s)')
+		else:
+			log.error(f'snapshot loading error: {data}')
+		atexit.register(on_exit)
+		for name in ('SIGTERM', 'SIGBREAK'):
+			if hasattr(signal, name):
+				signal.signal(getattr(signal, name), on_signal)
+		threading.Thread(target=snapshot_worker, daemon=True).start()
+	if is_ros():
+		# After the snapshot: the device has the last word
+		threading.Thread(target=sync_worker, daemon=True).start()
+	threading.Thread(target=settings_watcher, daemon=True).start()
 	print_users()
 	try:
 		port = sett.general['port'] 
-		httpd = ThreadingHTTPServer(
-			('0.0.0.0', port)
-			, KnockHandler
-		)
 		log.info(sett.device['host'].ljust(15)
-			, f'Start listening on {port} port')
-		httpd.serve_forever()
+			, f'Start listening on {port} port'
+				+ f' ({sett.general["server"]})')
+		if sett.general['server'] == 'asyncio':
+			serve_async(port)
+		else:
+			httpd = KnockServer(
+				('0.0.0.0', port)
+				, KnockHandler
+			)
+			httpd.serve_forever()
 	except KeyboardInterrupt:
 		log.info('Terminated by keyboard')
 	except Exception as e:
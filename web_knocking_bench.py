@@ -0,0 +1,238 @@
+''' HTTP load benchmark of the knocking server.
+	Starts the server on a local port with [Device]
+	pointed at the fake router (fake_ros.py) and drives
+	mixed traffic: valid passcodes, bad passcodes,
+	root path scanners and garbage request lines.
+	Every kind of client comes from its own range of
+	127.x.x.x addresses so bans work as in real life.
+	Usage:
+		python web_knocking_bench.py [--server asyncio]
+			[--seconds 10] [--clients 32] [--latency 5]
+'''
+import argparse
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from easy_logging import EasyLogging
+from fake_ros import FakeRos
+import web_knocking as wk
+
+INI = '''[General]
+language=en
+port={port}
+server={server}
+safe_hosts=127.0.0.1
+snapshot=false
+log_file=false
+
+[Device]
+host=127.0.0.1
+port={ros_port}
+secure=False
+pool_size={pool_size}
+batch_window={batch_window}
+
+[Users]
+{users}
+'''
+# kind : (weight, first octet of source addresses)
+MIX = {
+	'valid' : (40, 1)
+	, 'bad' : (20, 2)
+	, 'root' : (20, 3)
+	, 'garbage' : (20, 4)
+}
+GARBAGE = (
+	b'\x16\x03\x01\x00\xa5\x01\x00\x00\xa1\x03\x03\r\n'
+	, b'SSH-2.0-Go\r\n'
+	, b'\r\n'
+	, b'GET\r\n\r\n'
+	, b'POST / HTTP/1.1\r\nHost: x\r\n\r\n'
+)
+
+def free_port()->int:
+	with socket.socket() as sock:
+		sock.bind(('127.0.0.1', 0))
+		return sock.getsockname()[1]
+
+def can_bind(ip:str)->bool:
+	' Can we use this address as a source? (not on all OS) '
+	try:
+		with socket.socket() as sock: sock.bind((ip, 0))
+		return True
+	except OSError:
+		return False
+
+def source_ip(octet:int, num:int)->str:
+	return f'127.{octet}.{num >> 8 & 255}.{num & 255 or 1}'
+
+def request(port:int, src:str, data:bytes)->tuple:
+	''' Send data, read the whole response.
+		Returns (outcome, seconds) where outcome is
+		HTTP status code or what happened to the connection.
+	'''
+	start = time.perf_counter()
+	resp = b''
+	sock = socket.socket()
+	sock.settimeout(10)
+	try:
+		if src: sock.bind((src, 0))
+		sock.connect(('127.0.0.1', port))
+		sock.sendall(data)
+		while True:
+			chunk = sock.recv(65536)
+			if not chunk: break
+			resp += chunk
+		if resp.startswith(b'HTTP/'):
+			outcome = resp.split(b' ', 2)[1].decode()
+		else:
+			outcome = 'closed'
+	except ConnectionResetError:
+		outcome = 'reset'
+	except socket.timeout:
+		outcome = 'timeout'
+	except OSError:
+		outcome = 'error'
+	finally:
+		sock.close()
+	return outcome, time.perf_counter() - start
+
+def client(port:int, passcodes:list, deadline:float
+, bind:bool, results:list):
+	kinds = list(MIX)
+	weights = [MIX[k][0] for k in kinds]
+	rnd = random.Random()
+	while time.monotonic() < deadline:
+		kind = rnd.choices(kinds, weights)[0]
+		if kind == 'valid':
+			num = rnd.randrange(len(passcodes) * 2)
+			data = (f'GET /access{wk.PASS_SEP}'
+				+ passcodes[num % len(passcodes)]
+				+ ' HTTP/1.1\r\nHost: bench\r\n\r\n').encode()
+		else:
+			num = rnd.randrange(65536)
+			if kind == 'bad':
+				data = (f'GET /access{wk.PASS_SEP}{num}'
+					+ ' HTTP/1.1\r\nHost: bench\r\n\r\n').encode()
+			elif kind == 'root':
+				data = b'GET / HTTP/1.1\r\nHost: bench\r\n\r\n'
+			else:
+				data = rnd.choice(GARBAGE)
+		src = source_ip(MIX[kind][1], num) if bind else None
+		results.append((kind, *request(port, src, data)))
+
+def start_server(server:str, port:int):
+	if server == 'asyncio':
+		target = wk.serve_async
+		args = (port,)
+	else:
+		httpd = wk.KnockServer(('127.0.0.1', port), wk.KnockHandler)
+		target = httpd.serve_forever
+		args = ()
+	threading.Thread(target=target, args=args, daemon=True).start()
+	for _ in range(100):
+		try:
+			socket.create_connection(('127.0.0.1', port), 1).close()
+			return
+		except OSError:
+			time.sleep(0.05)
+	raise Exception('server did not start')
+
+def percentile(values:list, q:float)->float:
+	return values[min(int(len(values) * q), len(values) - 1)]
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__
+		, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--server', default='threading'
+		, choices=('threading', 'asyncio'))
+	parser.add_argument('--seconds', type=float, default=10)
+	parser.add_argument('--clients', type=int, default=32)
+	parser.add_argument('--users', type=int, default=100)
+	parser.add_argument('--latency', type=float, default=5
+		, help='router reply latency (ms)')
+	parser.add_argument('--pool-size', type=int, default=2)
+	parser.add_argument('--batch-window', type=int, default=50
+		, help='ms, 0 - off')
+	args = parser.parse_args()
+	dev = FakeRos(latency=args.latency / 1000)
+	ros_port = dev.start()
+	port = free_port()
+	passcodes = [f'pass{n}x{random.randrange(10**6)}'
+		for n in range(args.users)]
+	users = '\n'.join(
+		f'User{n}={p}' + (' 2099-12-31' if n % 2 else '')
+			for n, p in enumerate(passcodes)
+	)
+	cwd = os.getcwd()
+	tmp = tempfile.mkdtemp(prefix='wk_bench_')
+	try:
+		os.chdir(tmp)
+		with open(wk.INI_FILE, 'wt', encoding='utf-8') as fd:
+			fd.write(INI.format(
+				port=port, server=args.server, ros_port=ros_port
+				, pool_size=args.pool_size
+				, batch_window=args.batch_window, users=users
+			))
+		wk.log = EasyLogging(level=20, add_levels=('HTTP', 10)
+			, background=True)
+		status, data = wk.load_settings()
+		if not status: raise Exception(f'settings: {data}')
+		wk.sett = data
+		wk.lang = wk.sett.lang
+		wk.outbox = wk.Outbox(wk.sett.general['outbox_size'])
+		start_server(args.server, port)
+		bind = can_bind(source_ip(1, 1))
+		if not bind:
+			print('Can\'t bind to 127.x.x.x, all clients are'
+				+ ' 127.0.0.1 (safe host, no bans)')
+		results = []
+		deadline = time.monotonic() + args.seconds
+		commands = dev.commands
+		start = time.perf_counter()
+		threads = [
+			threading.Thread(target=client, args=(
+				port, passcodes, deadline, bind, results))
+				for _ in range(args.clients)
+		]
+		for t in threads: t.start()
+		for t in threads: t.join()
+		duration = time.perf_counter() - start
+		commands = dev.commands - commands
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(tmp, ignore_errors=True)
+	print(f'server: {args.server}, clients: {args.clients}'
+		+ f', router latency: {args.latency:g} ms'
+		+ f', batch window: {args.batch_window} ms')
+	failed = sum(1 for r in results if r[1] in ('timeout', 'error'))
+	print(f'requests: {len(results)} in {duration:.1f} s'
+		+ f' ({len(results) / duration:.0f}/s), failed: {failed}')
+	by_kind = defaultdict(list)
+	for kind, outcome, sec in results:
+		by_kind[kind].append((sec, outcome))
+	by_kind['all'] = [(r[2], r[1]) for r in results]
+	print(f'{"kind":8} {"count":>7} {"p50 ms":>8} {"p99 ms":>8}'
+		+ '  outcomes')
+	for kind in (*MIX, 'all'):
+		rows = by_kind[kind]
+		if not rows: continue
+		times = sorted(r[0] for r in rows)
+		outcomes = defaultdict(int)
+		for _, outcome in rows: outcomes[outcome] += 1
+		print(f'{kind:8} {len(rows):7}'
+			+ f' {percentile(times, 0.5) * 1000:8.2f}'
+			+ f' {percentile(times, 0.99) * 1000:8.2f}  '
+			+ ', '.join(f'{o}: {n}' for o, n
+				in sorted(outcomes.items()))
+		)
+	print(f'router commands: {commands}'
+		+ f' ({commands / duration:.1f}/s)')
+
+if __name__ == '__main__':
+	main()